@@ -17,6 +17,10 @@ def register():
         Category,
         Location,
         Event,
+        EventInstance,
+        EventRender,
+        EventTombstone,
+        CalendarAvailability,
         EventCategory,
         EventAlarm,
         EventAttendee,
@@ -2,13 +2,15 @@
 # this repository contains the full copyright notices and license terms.
 import urlparse
 import urllib
+import email.utils
 from string import atoi
 import xml.dom.minidom
-from pywebdav.lib import propfind
+from pywebdav.lib import propfind, report
 from pywebdav.lib.errors import DAV_NotFound, DAV_Error, DAV_Forbidden
-from pywebdav.lib.utils import get_uriparentpath
+from pywebdav.lib.utils import get_uriparentpath, rfc1123_date
 from pywebdav.lib.constants import DAV_VERSION_1, DAV_VERSION_2
-from trytond.protocols.webdav import TrytonDAVInterface, CACHE, \
+from trytond.protocols import webdav as webdav_protocol
+from trytond.protocols.webdav import TrytonDAVInterface, \
         WebDAVAuthRequestHandler
 from trytond.pool import Pool
 from trytond.transaction import Transaction
@@ -24,8 +26,12 @@ TrytonDAVInterface.PROPS['urn:ietf:params:xml:ns:caldav'] = (
     'schedule-outbox-URL',
     )
 TrytonDAVInterface.PROPS['DAV:'] = tuple(list(TrytonDAVInterface.PROPS['DAV:'])
-    + ['principal-collection-set'])
+    + ['principal-collection-set', 'sync-token'])
+TrytonDAVInterface.PROPS['http://calendarserver.org/ns/'] = (
+    'getctag',
+    )
 TrytonDAVInterface.M_NS['urn:ietf:params:xml:ns:caldav'] = '_get_caldav'
+TrytonDAVInterface.M_NS['http://calendarserver.org/ns/'] = '_get_cs'
 DAV_VERSION_1['version'] += ',calendar-access,calendar-schedule'
 DAV_VERSION_2['version'] += ',calendar-access,calendar-schedule'
 
@@ -63,7 +69,8 @@ def _get_caldav_calendar_description(self, uri):
     except KeyError:
         raise DAV_NotFound
     try:
-        res = Collection.get_calendar_description(dburi, cache=CACHE)
+        res = Collection.get_calendar_description(dburi,
+            cache=webdav_protocol.CACHE)
     except AttributeError:
         raise DAV_NotFound
     except DAV_Error, exception:
@@ -88,7 +95,7 @@ def _get_caldav_calendar_data(self, uri):
     except KeyError:
         raise DAV_NotFound
     try:
-        res = Collection.get_calendar_data(dburi, cache=CACHE)
+        res = Collection.get_calendar_data(dburi, cache=webdav_protocol.CACHE)
     except AttributeError:
         raise DAV_NotFound
     except DAV_Error, exception:
@@ -112,7 +119,8 @@ def _get_caldav_calendar_home_set(self, uri):
     except KeyError:
         raise DAV_NotFound
     try:
-        res = Collection.get_calendar_home_set(dburi, cache=CACHE)
+        res = Collection.get_calendar_home_set(dburi,
+            cache=webdav_protocol.CACHE)
     except AttributeError:
         raise DAV_NotFound
     except DAV_Error, exception:
@@ -146,7 +154,8 @@ def _get_caldav_calendar_user_address_set(self, uri):
     except KeyError:
         raise DAV_NotFound
     try:
-        res = Collection.get_calendar_user_address_set(dburi, cache=CACHE)
+        res = Collection.get_calendar_user_address_set(dburi,
+            cache=webdav_protocol.CACHE)
     except AttributeError:
         raise DAV_NotFound
     except DAV_Error, exception:
@@ -176,7 +185,8 @@ def _get_caldav_schedule_inbox_URL(self, uri):
     except KeyError:
         raise DAV_NotFound
     try:
-        res = Collection.get_schedule_inbox_URL(dburi, cache=CACHE)
+        res = Collection.get_schedule_inbox_URL(dburi,
+            cache=webdav_protocol.CACHE)
     except AttributeError:
         raise DAV_NotFound
     except DAV_Error, exception:
@@ -208,7 +218,8 @@ def _get_caldav_schedule_outbox_URL(self, uri):
     except KeyError:
         raise DAV_NotFound
     try:
-        res = Collection.get_schedule_outbox_URL(dburi, cache=CACHE)
+        res = Collection.get_schedule_outbox_URL(dburi,
+            cache=webdav_protocol.CACHE)
     except AttributeError:
         raise DAV_NotFound
     except DAV_Error, exception:
@@ -253,6 +264,161 @@ TrytonDAVInterface._get_dav_principal_collection_set = \
     _get_dav_principal_collection_set
 
 
+def _get_cs_getctag(self, uri):
+    dbname, dburi = self._get_dburi(uri)
+    if not dbname or not dburi or not dburi.startswith('Calendars/'):
+        raise DAV_NotFound
+    pool = Pool(Transaction().cursor.database_name)
+    Collection = pool.get('webdav.collection')
+    try:
+        res = Collection.get_ctag(dburi, cache=webdav_protocol.CACHE)
+    except DAV_Error, exception:
+        self._log_exception(exception)
+        raise
+    except Exception, exception:
+        self._log_exception(exception)
+        raise DAV_Error(500)
+    return res
+
+TrytonDAVInterface._get_cs_getctag = _get_cs_getctag
+
+_prev_get_dav_getetag = TrytonDAVInterface._get_dav_getetag
+
+
+def _get_dav_getetag(self, uri):
+    dbname, dburi = self._get_dburi(uri)
+    if not dbname or not dburi or not dburi.startswith('Calendars/'):
+        return _prev_get_dav_getetag(self, uri)
+    pool = Pool(Transaction().cursor.database_name)
+    Collection = pool.get('webdav.collection')
+    try:
+        res = Collection.get_etag(dburi, cache=webdav_protocol.CACHE)
+    except DAV_Error, exception:
+        self._log_exception(exception)
+        raise
+    except Exception, exception:
+        self._log_exception(exception)
+        raise DAV_Error(500)
+    if res is None:
+        return _prev_get_dav_getetag(self, uri)
+    return res
+
+TrytonDAVInterface._get_dav_getetag = _get_dav_getetag
+
+
+def _match_etag(header, dc, uri, weak=False):
+    '''
+    Test if the entity tag of the uri matches one of the header
+    The weak comparison is used for If-None-Match and the strong one for
+    If-Match
+    '''
+    etag = None
+    if dc.exists(uri):
+        try:
+            etag = dc.get_prop(uri, 'DAV:', 'getetag')
+        except DAV_Error:
+            pass
+    for match in header.split(','):
+        match = match.strip()
+        if match.startswith('W/'):
+            if not weak:
+                continue
+            match = match[2:]
+        if match == '*' and etag is not None:
+            return True, etag
+        elif match == etag:
+            return True, etag
+    return False, etag
+
+
+def _get_dav_sync_token(self, uri):
+    dbname, dburi = self._get_dburi(uri)
+    if not dbname or not dburi or not dburi.startswith('Calendars/'):
+        raise DAV_NotFound
+    pool = Pool(Transaction().cursor.database_name)
+    Collection = pool.get('webdav.collection')
+    try:
+        res = Collection.get_sync_token(dburi, cache=webdav_protocol.CACHE)
+    except DAV_Error, exception:
+        self._log_exception(exception)
+        raise
+    except Exception, exception:
+        self._log_exception(exception)
+        raise DAV_Error(500)
+    return res
+
+TrytonDAVInterface._get_dav_sync_token = _get_dav_sync_token
+
+
+def _get_caldav_sync_collection(self, uri, sync_token):
+    dbname, dburi = self._get_dburi(uri)
+    if not dbname or not dburi or not dburi.startswith('Calendars/'):
+        raise DAV_Forbidden
+    pool = Pool(Transaction().cursor.database_name)
+    Collection = pool.get('webdav.collection')
+    try:
+        changed, removed, sync_token = Collection.sync_collection(dburi,
+            sync_token, cache=webdav_protocol.CACHE)
+    except DAV_Error, exception:
+        self._log_exception(exception)
+        raise
+    except Exception, exception:
+        self._log_exception(exception)
+        raise DAV_Error(500)
+    scheme, netloc, path, params, query, fragment = urlparse.urlparse(uri)
+    if path[-1:] != '/':
+        path += '/'
+
+    def uris(childs):
+        return [urlparse.urlunparse((scheme, netloc,
+                    path + child.encode('utf-8'), params, query, fragment))
+            for child in childs]
+    return uris(changed), uris(removed), sync_token
+
+TrytonDAVInterface._get_caldav_sync_collection = _get_caldav_sync_collection
+
+_createResponse = report.REPORT.createResponse
+
+
+def createResponse(self):
+    if (self.filter.namespaceURI != 'DAV:'
+            or self.filter.localName != 'sync-collection'):
+        return _createResponse(self)
+    dc = self._dataclass
+    if not dc.exists(self._uri):
+        raise DAV_NotFound
+    sync_token = ''
+    for e in self.filter.childNodes:
+        if e.namespaceURI == 'DAV:' and e.localName == 'sync-token':
+            sync_token = ''.join(t.data for t in e.childNodes
+                if t.nodeType == t.TEXT_NODE).strip()
+    # The Depth header is not used as calendars contain only events
+    changed, removed, sync_token = dc._get_caldav_sync_collection(self._uri,
+        sync_token)
+
+    doc = domimpl.createDocument(None, 'multistatus', None)
+    ms = doc.documentElement
+    ms.setAttribute('xmlns:D', 'DAV:')
+    ms.tagName = 'D:multistatus'
+    for uri in changed:
+        gp, bp = self.get_propvalues(uri)
+        ms.appendChild(self.mk_prop_response(uri, gp, bp, doc))
+    for uri in removed:
+        res = self.mk_prop_response(uri, {}, {}, doc)
+        for ps in res.getElementsByTagName('D:propstat'):
+            res.removeChild(ps)
+        status = doc.createElement('D:status')
+        status.appendChild(doc.createTextNode('HTTP/1.1 404 Not Found'))
+        res.appendChild(status)
+        ms.appendChild(res)
+    token = doc.createElement('D:sync-token')
+    token.appendChild(doc.createTextNode(sync_token))
+    ms.appendChild(token)
+    return doc.toxml(encoding='utf-8')
+
+report.REPORT.createResponse = createResponse
+
+
 def _get_caldav_post(self, uri, body, contenttype=''):
     dbname, dburi = self._get_dburi(uri)
     if not dbname:
@@ -273,6 +439,27 @@ def _get_caldav_post(self, uri, body, contenttype=''):
 
 TrytonDAVInterface._get_caldav_post = _get_caldav_post
 
+
+def _get_caldav_data_stream(self, uri):
+    dbname, dburi = self._get_dburi(uri)
+    if not dbname:
+        raise DAV_NotFound
+    pool = Pool(Transaction().cursor.database_name)
+    Collection = pool.get('webdav.collection')
+    try:
+        res = Collection.get_data_stream(dburi, cache=webdav_protocol.CACHE)
+    except AttributeError:
+        raise DAV_NotFound
+    except DAV_Error, exception:
+        self._log_exception(exception)
+        raise
+    except Exception, exception:
+        self._log_exception(exception)
+        raise DAV_Error(500)
+    return res
+
+TrytonDAVInterface._get_caldav_data_stream = _get_caldav_data_stream
+
 _prev_do_POST = WebDAVAuthRequestHandler.do_POST
 
 
@@ -303,3 +490,150 @@ def do_POST(self):
     return _prev_do_POST(self)
 
 WebDAVAuthRequestHandler.do_POST = do_POST
+
+_prev_do_GET = WebDAVAuthRequestHandler.do_GET
+
+
+def do_GET(self):
+    dc = self.IFACE_CLASS
+
+    uri = urlparse.urljoin(self.get_baseuri(dc), self.path)
+    uri = urllib.unquote(uri)
+
+    dbname, dburi = TrytonDAVInterface.get_dburi(uri)
+    if dburi and dburi.startswith('Calendars/'):
+        if 'If-Match' in self.headers:
+            match, _ = _match_etag(self.headers['If-Match'], dc, uri)
+            if not match:
+                self.send_status(412)
+                self.log_request(412)
+                return 412
+        if 'If-None-Match' in self.headers:
+            match, etag = _match_etag(self.headers['If-None-Match'], dc, uri,
+                weak=True)
+            if match:
+                self.send_body(None, 304, 'Not Modified', None, headers={
+                        'ETag': etag,
+                        })
+                self.log_request(304)
+                return 304
+            # If-Modified-Since is ignored with If-None-Match
+            return _prev_do_GET(self)
+    since = email.utils.parsedate_tz(self.headers.get('If-Modified-Since',
+            ''))
+    # Only the published free/busy has a last modification which changes
+    # also on deletion
+    if dburi and dburi.startswith('Calendars/') and dburi.endswith('.vfb') \
+            and since:
+        try:
+            lastmodified = dc.get_lastmodified(uri)
+        except DAV_Error:
+            return _prev_do_GET(self)
+        # HTTP dates have a resolution of one second
+        if int(lastmodified) <= email.utils.mktime_tz(since):
+            self.send_body(None, 304, 'Not Modified', None, headers={
+                    'Last-Modified': rfc1123_date(lastmodified),
+                    })
+            self.log_request(304)
+            return 304
+    # Stream the export of whole calendar
+    if dburi and dburi.startswith('Calendars/') and dburi.endswith('.ics') \
+            and '/' not in dburi[10:] and 'Range' not in self.headers:
+        try:
+            DATA = dc._get_caldav_data_stream(uri)
+        except DAV_Error, exception:
+            ec, _ = exception
+            return self.send_status(ec)
+        # Without chunked transfer the end of the body is the end of the
+        # connection
+        chunked = (self.protocol_version >= 'HTTP/1.1'
+            and self.request_version != 'HTTP/1.0')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/calendar')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+            self.close_connection = 1
+        self._send_dav_version()
+        for name, prop in (('Last-Modified', 'getlastmodified'),
+                ('ETag', 'getetag')):
+            try:
+                self.send_header(name, dc.get_prop(uri, 'DAV:', prop))
+            except DAV_Error:
+                pass
+        self.end_headers()
+        for chunk in DATA:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            if not chunk:
+                continue
+            if chunked:
+                self.wfile.write('%x\r\n' % len(chunk))
+            self.wfile.write(chunk)
+            if chunked:
+                self.wfile.write('\r\n')
+        if chunked:
+            self.wfile.write('0\r\n\r\n')
+        self.log_request(200)
+        return 200
+    return _prev_do_GET(self)
+
+WebDAVAuthRequestHandler.do_GET = do_GET
+
+_prev_do_PUT = WebDAVAuthRequestHandler.do_PUT
+
+
+def do_PUT(self):
+    dc = self.IFACE_CLASS
+
+    uri = urlparse.urljoin(self.get_baseuri(dc), self.path)
+    uri = urllib.unquote(uri)
+
+    dbname, dburi = TrytonDAVInterface.get_dburi(uri)
+    if dburi and dburi.startswith('Calendars/'):
+        # Compare the entity tags like do_GET instead of pywebdav
+        if 'If-Match' in self.headers:
+            match, _ = _match_etag(self.headers['If-Match'], dc, uri)
+            if not match:
+                self.send_status(412)
+                self.log_request(412)
+                return 412
+            del self.headers['If-Match']
+        if 'If-None-Match' in self.headers:
+            match, _ = _match_etag(self.headers['If-None-Match'], dc, uri,
+                weak=True)
+            if match:
+                self.send_status(412)
+                self.log_request(412)
+                return 412
+            del self.headers['If-None-Match']
+    # The chunked body is stored after the response is sent
+    if (not dburi or not dburi.startswith('Calendars/')
+            or self.headers.get('Transfer-Encoding', '').lower()
+            == 'chunked'):
+        return _prev_do_PUT(self)
+    send_body = self.send_body
+
+    def send_body_etag(DATA, code=None, msg=None, desc=None,
+            ctype='application/octet-stream', headers=None):
+        # Return the entity tag of the stored event instead of the previous
+        headers = dict(headers or {})
+        headers.pop('ETag', None)
+        if code == 201:
+            # The cached entity tags are outdated
+            webdav_protocol.CACHE.clear()
+            if dc.exists(uri):
+                try:
+                    headers['ETag'] = dc.get_prop(uri, 'DAV:', 'getetag')
+                except DAV_Error:
+                    pass
+        return send_body(DATA, code=code, msg=msg, desc=desc, ctype=ctype,
+            headers=headers)
+    self.send_body = send_body_etag
+    try:
+        return _prev_do_PUT(self)
+    finally:
+        del self.send_body
+
+WebDAVAuthRequestHandler.do_PUT = do_PUT
@@ -3,10 +3,21 @@
 import uuid
 import vobject
 import dateutil.tz
+import dateutil.rrule
+import dateutil.relativedelta
 import pytz
 import datetime
+import heapq
+import weakref
 import xml.dom.minidom
-from sql import Table, Column
+from sql import Table, Column, Null
+from sql.operators import Exists, BinaryOperator
+from sql.functions import Function, CurrentTimestamp
+from sql.conditionals import Coalesce, Greatest
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from trytond.model import Model, ModelSQL, ModelView, fields
 from trytond.tools import reduce_ids, grouped_slice
@@ -14,16 +25,237 @@ from trytond import backend
 from trytond.pyson import If, Bool, Eval, PYSONEncoder
 from trytond.transaction import Transaction
 from trytond.cache import Cache
+from trytond.config import config
 from trytond.pool import Pool
 
 __all__ = ['Calendar', 'ReadUser', 'WriteUser', 'Category', 'Location',
-    'Event', 'EventCategory', 'AlarmMixin', 'EventAlarm', 'AttendeeMixin',
-    'EventAttendee', 'DateMixin', 'EventRDate', 'EventExDate', 'RRuleMixin',
-    'EventRRule', 'EventExRule']
+    'Event', 'EventInstance', 'EventRender', 'EventTombstone',
+    'CalendarAvailability', 'EventCategory', 'AlarmMixin', 'EventAlarm',
+    'AttendeeMixin', 'EventAttendee', 'DateMixin', 'EventRDate', 'EventExDate',
+    'RRuleMixin', 'EventRRule', 'EventExRule']
 
 tzlocal = dateutil.tz.tzlocal()
 tzutc = dateutil.tz.tzutc()
+AVAILABILITY_SLOTS = 96
 domimpl = xml.dom.minidom.getDOMImplementation()
+ICAL_FOOTER = 'END:VCALENDAR\r\n'
+# The calendars of which the sync token is changed by each cursor
+_changed_sync_tokens = weakref.WeakKeyDictionary()
+ICAL_HEADER = vobject.iCalendar().serialize()[:-len(ICAL_FOOTER)]
+
+
+class TsRange(Function):
+    __slots__ = ()
+    _function = 'TSRANGE'
+
+
+class RangeOverlap(BinaryOperator):
+    __slots__ = ()
+    _operator = '&&'
+
+
+def _instance_start():
+    '''
+    Return the date from which the instances are materialized
+    '''
+    return datetime.datetime.combine(datetime.date.today(), datetime.time())\
+        .replace(tzinfo=tzlocal)
+
+
+def _instance_horizon():
+    '''
+    Return the date up to which the instances are materialized
+    '''
+    # DateTime fields do not store the microseconds
+    return (datetime.datetime.now().replace(microsecond=0, tzinfo=tzlocal)
+        + datetime.timedelta(days=config.getint('calendar',
+                'instance_horizon', default=730)))
+
+
+def _naive(date):
+    '''
+    Return the timezone aware date as naive local time like it is stored
+    '''
+    return date.astimezone(tzlocal).replace(tzinfo=None)
+
+
+def _availability_bitmaps(periods):
+    '''
+    Return a dictionary of the availability bitmaps by date and fbtype for
+    the periods as tuples of (dtstart, dtend, fbtype)
+    The days are divided in AVAILABILITY_SLOTS slots of local time
+    '''
+    slot = 24 * 60 * 60 // AVAILABILITY_SLOTS
+    bitmaps = {}
+    for dtstart, dtend, fbtype in periods:
+        if fbtype == 'FREE':
+            continue
+        dtstart = dtstart.astimezone(tzlocal).replace(tzinfo=None)
+        dtend = dtend.astimezone(tzlocal).replace(tzinfo=None)
+        day = datetime.datetime.combine(dtstart.date(), datetime.time())
+        while True:
+            next_day = day + datetime.timedelta(days=1)
+            first = int((max(dtstart, day) - day).total_seconds()) // slot
+            last = -(-int((min(dtend, next_day) - day).total_seconds())
+                // slot)
+            # Mark at least the slot of an instant
+            last = max(last, first + 1)
+            bitmap = ((1 << last) - 1) ^ ((1 << first) - 1)
+            fbtypes = bitmaps.setdefault(day.date(), {})
+            fbtypes[fbtype] = fbtypes.get(fbtype, 0) | bitmap
+            if dtend <= next_day:
+                break
+            day = next_day
+    return bitmaps
+
+
+def _skip_periods(kwargs, start):
+    '''
+    Return the dateutil rrule kwargs with dtstart moved by whole periods up
+    to one period before start when it does not change the recurrence
+    '''
+    dtstart = kwargs['dtstart']
+    if start is None or start <= dtstart or kwargs.get('count'):
+        return kwargs
+    start = start.astimezone(dtstart.tzinfo)
+    freq, interval = kwargs['freq'], kwargs['interval']
+    # dateutil defaults the missing BYxxx from dtstart
+    explicit = any(k in kwargs
+        for k in ('byweekday', 'bymonthday', 'byyearday', 'byweekno'))
+    if freq == dateutil.rrule.DAILY:
+        periods = (start.date() - dtstart.date()).days // interval
+        delta = dateutil.relativedelta.relativedelta(days=interval)
+    elif freq == dateutil.rrule.WEEKLY:
+        periods = (start.date() - dtstart.date()).days // (7 * interval)
+        delta = dateutil.relativedelta.relativedelta(weeks=interval)
+    elif freq == dateutil.rrule.MONTHLY and (explicit or dtstart.day <= 28):
+        periods = ((start.year - dtstart.year) * 12
+            + start.month - dtstart.month) // interval
+        delta = dateutil.relativedelta.relativedelta(months=interval)
+    elif freq == dateutil.rrule.YEARLY and (explicit
+            or (dtstart.month, dtstart.day) != (2, 29)):
+        periods = (start.year - dtstart.year) // interval
+        delta = dateutil.relativedelta.relativedelta(years=interval)
+    else:
+        return kwargs
+    # Keep one period before start for the BYxxx expansion
+    periods -= 1
+    if periods <= 0:
+        return kwargs
+    kwargs = kwargs.copy()
+    kwargs['dtstart'] = dtstart + delta * periods
+    return kwargs
+
+
+def _datetime64(date, tzinfo):
+    '''
+    Return a numpy datetime64 for the wall clock of date in tzinfo
+    '''
+    return numpy.datetime64(date.astimezone(tzinfo).replace(tzinfo=None), 's')
+
+
+def _numpy_rrule(kwargs):
+    '''
+    Test if the dateutil rrule kwargs can be expanded with numpy
+    '''
+    if numpy is None or not set(kwargs) <= set(['freq', 'dtstart',
+                'interval', 'until', 'count', 'wkst', 'byweekday']):
+        return False
+    freq = kwargs['freq']
+    if freq == dateutil.rrule.WEEKLY:
+        return all(w.n is None for w in kwargs.get('byweekday', []))
+    elif 'byweekday' in kwargs:
+        return False
+    elif freq == dateutil.rrule.DAILY:
+        return True
+    elif freq == dateutil.rrule.MONTHLY:
+        return kwargs['dtstart'].day <= 28
+    return False
+
+
+def _numpy_recurrences(kwargs, start=None, end=None, size=1024):
+    '''
+    Yield numpy arrays of the recurrences of the dateutil rrule kwargs as
+    wall clock of dtstart between about start and end
+    '''
+    dtstart = kwargs['dtstart']
+    first = _datetime64(dtstart, dtstart.tzinfo)
+    interval = kwargs['interval']
+    until = count = None
+    if kwargs.get('until'):
+        until = _datetime64(kwargs['until'], dtstart.tzinfo)
+    count = kwargs.get('count')
+    margin = numpy.timedelta64(1, 'D')
+    if end is not None:
+        end = _datetime64(end, dtstart.tzinfo) + margin
+        if until is None or end < until:
+            until = end
+
+    if kwargs['freq'] == dateutil.rrule.MONTHLY:
+        month = first.astype('datetime64[M]')
+        offset = first - month.astype('datetime64[s]')
+        step = numpy.timedelta64(interval, 'M')
+
+        def periods(index):
+            return (month + index * step).astype('datetime64[s]') + offset
+    else:
+        offsets = [0]
+        step = numpy.timedelta64(interval, 'D')
+        if kwargs['freq'] == dateutil.rrule.WEEKLY:
+            wkst = getattr(kwargs.get('wkst'), 'weekday', 0)
+            weekdays = ([w.weekday for w in kwargs.get('byweekday', [])]
+                or [dtstart.weekday()])
+            # Offsets from dtstart inside the week starting on wkst
+            offsets = sorted(set((w - wkst) % 7
+                    - (dtstart.weekday() - wkst) % 7 for w in weekdays))
+            step *= 7
+        offsets = numpy.array(offsets, 'timedelta64[D]')
+
+        def periods(index):
+            return ((first + index * step)[:, None] + offsets).ravel()
+
+    index = 0
+    if start is not None and count is None:
+        start = _datetime64(start, dtstart.tzinfo) - margin
+        if kwargs['freq'] == dateutil.rrule.MONTHLY:
+            delta = (start.astype('datetime64[M]') - month) / step
+        else:
+            delta = (start - first) / step
+        # Keep one period before start like _skip_periods
+        index = max(int(numpy.floor(delta)) - 1, 0)
+    while True:
+        recurrences = periods(numpy.arange(index, index + size))
+        recurrences = recurrences[recurrences >= first]
+        stop = False
+        if until is not None:
+            stop = (recurrences > until).any()
+            recurrences = recurrences[recurrences <= until]
+        if count is not None:
+            recurrences = recurrences[:count]
+            count -= len(recurrences)
+            stop = stop or not count
+        yield recurrences
+        if stop:
+            break
+        index += size
+
+
+class StatsCache(Cache):
+    '''
+    A Cache which counts its hits and misses
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(StatsCache, self).__init__(*args, **kwargs)
+        self.hits = self.misses = 0
+
+    def get(self, key, default=None):
+        result = super(StatsCache, self).get(key, default=self)
+        if result is self:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return result
 
 
 class Calendar(ModelSQL, ModelView):
@@ -38,7 +270,14 @@ class Calendar(ModelSQL, ModelView):
             'calendar', 'user', 'Read Users')
     write_users = fields.Many2Many('calendar.calendar-write-res.user',
             'calendar', 'user', 'Write Users')
+    availability_until = fields.Date('Availability Until', readonly=True,
+        help='The date up to which the availability bitmaps are stored.')
+    sync_token = fields.Integer('Sync Token', readonly=True,
+        help='Incremented on each change of the events.')
     _get_name_cache = Cache('calendar_calendar.get_name')
+    _freebusy_cache = StatsCache('calendar_calendar.freebusy', context=False)
+    _published_freebusy_cache = Cache('calendar_calendar.published_freebusy',
+        context=False)
 
     @classmethod
     def __setup__(cls):
@@ -51,9 +290,18 @@ class Calendar(ModelSQL, ModelView):
             ]
         cls._order.insert(0, ('name', 'ASC'))
         cls._error_messages.update({
-                'invalid_name': 'Calendar name "%s" can not end with .ics',
+                'invalid_name': ('Calendar name "%s" can not end with .ics '
+                    'or .vfb'),
                 })
 
+    @staticmethod
+    def default_availability_until():
+        return _instance_horizon().date()
+
+    @staticmethod
+    def default_sync_token():
+        return 0
+
     @classmethod
     def create(cls, vlist):
         calendars = super(Calendar, cls).create(vlist)
@@ -81,9 +329,9 @@ class Calendar(ModelSQL, ModelView):
 
     def check_name(self):
         '''
-        Check the name doesn't end with .ics
+        Check the name doesn't end with .ics or .vfb
         '''
-        if self.name.endswith('.ics'):
+        if self.name.endswith(('.ics', '.vfb')):
             self.raise_user_error('invalid_name', (self.name,))
 
     @classmethod
@@ -116,156 +364,520 @@ class Calendar(ModelSQL, ModelView):
                 ('calendar', '=', self.id),
                 ('parent', '=', None),
                 ])
+        icals = Event.events2ical(events)
         for event in events:
-            ical2 = event.event2ical()
-            ical.vevent_list.extend(ical2.vevent_list)
+            ical.vevent_list.extend(icals[event.id].vevent_list)
         return ical
 
-    @property
-    def _fbtype(self):
+    def calendar2ical_stream(self):
         '''
-        Return the freebusy type for give transparent and status
+        Yield the serialized iCalendar for the given calendar_id by chunks
+        The events are serialized by batch to not keep them all in memory
         '''
-        if self.transp == 'opaque':
-            if not self.status or self.status == 'confirmed':
-                fbtype = 'BUSY'
-            elif self.status == 'cancelled':
-                fbtype = 'FREE'
-            elif self.status == 'tentative':
-                fbtype = 'BUSY-TENTATIVE'
-            else:
-                fbtype = 'BUSY'
-        else:
-            fbtype = 'FREE'
-        return fbtype
+        Event = Pool().get('calendar.event')
+
+        yield ICAL_HEADER
+        events = Event.search([
+                ('calendar', '=', self.id),
+                ('parent', '=', None),
+                ])
+        tzids = set()
+        for sub_events in grouped_slice(events):
+            sub_events = Event.browse([e.id for e in sub_events])
+            occurences = Event._events_occurences(sub_events)
+            records = []
+            for event in sub_events:
+                records.append(event)
+                records.extend(occurences.get(event.id, []))
+            vevents = Event.events2vevents(records)
+            chunk, body = [], []
+            for record in records:
+                vevent, vtimezones = vevents[record.id]
+                for tzid, vtimezone in vtimezones:
+                    if tzid not in tzids:
+                        tzids.add(tzid)
+                        chunk.append(vtimezone)
+                body.append(vevent)
+            yield ''.join(chunk + body)
+        yield ICAL_FOOTER
 
     @classmethod
-    def freebusy(cls, calendar_id, dtstart, dtend):
+    def freebusy(cls, calendar_id, dtstart, dtend, coalesce=None):
         '''
         Return an iCalendar object for the given calendar_id with the
         vfreebusy objects between the two dates
         '''
-        Event = Pool().get('calendar.event')
+        return cls.freebusy_many([calendar_id], dtstart, dtend,
+            coalesce=coalesce)[calendar_id]
 
-        ical = vobject.iCalendar()
-        ical.add('method').value = 'REPLY'
-        ical.add('vfreebusy')
+    @classmethod
+    def freebusy_many(cls, calendar_ids, dtstart, dtend, coalesce=None):
+        '''
+        Return a dictionary of iCalendar objects by calendar_ids with the
+        vfreebusy objects between the two dates
+        If coalesce is set, the overlapping and adjacent periods of the same
+        fbtype are merged into one freebusy by fbtype otherwise the default
+        is taken from the configuration
+        '''
+        if coalesce is None:
+            coalesce = config.getboolean('calendar', 'freebusy_coalesce',
+                default=False)
         if not isinstance(dtstart, datetime.datetime):
-            ical.vfreebusy.add('dtstart').value = dtstart
+            ical_dtstart = dtstart
             dtstart = datetime.datetime.combine(dtstart, datetime.time())\
                 .replace(tzinfo=tzlocal)
         else:
-            ical.vfreebusy.add('dtstart').value = dtstart.astimezone(tzutc)
+            if not dtstart.tzinfo:
+                dtstart = dtstart.replace(tzinfo=tzlocal)
+            ical_dtstart = dtstart.astimezone(tzutc)
         if not isinstance(dtend, datetime.datetime):
-            ical.vfreebusy.add('dtend').value = dtend
+            ical_dtend = dtend
             dtend = datetime.datetime.combine(dtend, datetime.time.max)\
                 .replace(tzinfo=tzlocal)
         else:
-            ical.vfreebusy.add('dtend').value = dtend.astimezone(tzutc)
+            if not dtend.tzinfo:
+                dtend = dtend.replace(tzinfo=tzlocal)
+            ical_dtend = dtend.astimezone(tzutc)
+
+        periods = cls._freebusy_periods_cached(calendar_ids, dtstart, dtend)
+        result = {}
+        for calendar_id in calendar_ids:
+            ical = vobject.iCalendar()
+            ical.add('method').value = 'REPLY'
+            ical.add('vfreebusy')
+            ical.vfreebusy.add('dtstart').value = ical_dtstart
+            ical.vfreebusy.add('dtend').value = ical_dtend
+            if coalesce:
+                coalesced = cls._coalesce_periods(periods[calendar_id])
+                for fbtype in sorted(coalesced):
+                    freebusy = ical.vfreebusy.add('freebusy')
+                    freebusy.fbtype_param = fbtype
+                    freebusy.value = [(
+                            freebusy_dtstart.astimezone(tzutc),
+                            freebusy_dtend.astimezone(tzutc))
+                        for freebusy_dtstart, freebusy_dtend
+                        in coalesced[fbtype]]
+                result[calendar_id] = ical
+                continue
+            for freebusy_dtstart, freebusy_dtend, fbtype \
+                    in periods[calendar_id]:
+                # Don't group freebusy as sunbird doesn't handle it
+                freebusy = ical.vfreebusy.add('freebusy')
+                freebusy.fbtype_param = fbtype
+                freebusy.value = [(
+                        freebusy_dtstart.astimezone(tzutc),
+                        freebusy_dtend.astimezone(tzutc))]
+            result[calendar_id] = ical
+        return result
+
+    @staticmethod
+    def _coalesce_periods(periods):
+        '''
+        Return a dictionary of the lists of periods by fbtype with the
+        overlapping and adjacent periods merged
+        '''
+        coalesced = {}
+        for dtstart, dtend, fbtype in sorted(periods):
+            fbtype_periods = coalesced.setdefault(fbtype, [])
+            if fbtype_periods and dtstart <= fbtype_periods[-1][1]:
+                if dtend > fbtype_periods[-1][1]:
+                    fbtype_periods[-1] = (fbtype_periods[-1][0], dtend)
+            else:
+                fbtype_periods.append((dtstart, dtend))
+        return coalesced
+
+    @classmethod
+    def _freebusy_periods_cached(cls, calendar_ids, dtstart, dtend):
+        '''
+        Return the result of _freebusy_periods using the cache keyed by
+        calendar, the two dates and the sync token of the calendar
+        The calendars changed by the transaction are not cached
+        '''
+        sync_tokens = cls._sync_tokens(calendar_ids)
+        periods, keys = {}, {}
+        for calendar_id in calendar_ids:
+            if cls._sync_token_changed(calendar_id):
+                continue
+            keys[calendar_id] = (calendar_id, dtstart, dtend,
+                sync_tokens[calendar_id])
+            calendar_periods = cls._freebusy_cache.get(keys[calendar_id])
+            if calendar_periods is not None:
+                periods[calendar_id] = calendar_periods
+        missing = [i for i in calendar_ids if i not in periods]
+        if missing:
+            periods.update(cls._freebusy_periods(missing, dtstart, dtend))
+            for calendar_id in missing:
+                if calendar_id in keys:
+                    cls._freebusy_cache.set(keys[calendar_id],
+                        periods[calendar_id])
+        return periods
+
+    @classmethod
+    def _sync_tokens(cls, calendar_ids):
+        '''
+        Return a dictionary of the current sync token by calendar_ids
+        It is read from the table as it is updated by SQL
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        sync_tokens = dict((i, 0) for i in calendar_ids)
+        for sub_ids in grouped_slice(calendar_ids):
+            cursor.execute(*table.select(table.id, table.sync_token,
+                    where=reduce_ids(table.id, sub_ids)))
+            for calendar_id, sync_token in cursor.fetchall():
+                sync_tokens[calendar_id] = sync_token or 0
+        return sync_tokens
 
+    @staticmethod
+    def _sync_token_changed(calendar_id):
+        '''
+        Test if the sync token of the calendar is changed by the transaction
+        Such token may be rolled back and given again to other changes so it
+        can not be used as cache key
+        '''
+        return calendar_id in _changed_sync_tokens.get(Transaction().cursor,
+            ())
+
+    @classmethod
+    def _next_sync_token(cls, calendar_id):
+        '''
+        Increment and return the sync token of the calendar
+        The update locks the calendar until the end of the transaction so the
+        tokens are committed in order.
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        _changed_sync_tokens.setdefault(cursor, set()).add(calendar_id)
+        cursor.execute(*table.update(
+                columns=[table.sync_token],
+                values=[Coalesce(table.sync_token, 0) + 1],
+                where=table.id == calendar_id))
+        cursor.execute(*table.select(table.sync_token,
+                where=table.id == calendar_id))
+        sync_token, = cursor.fetchone()
+        return sync_token
+
+    @classmethod
+    def published_freebusy(cls, calendar_ids):
+        '''
+        Return a dictionary of the serialized free/busy by calendar_ids
+        published over the rolling window
+        The data is rendered again only when the sync token of the calendar
+        or the first day of the window change
+        The calendars changed by the transaction are not cached
+        '''
+        today = datetime.date.today()
+        sync_tokens = cls._sync_tokens(calendar_ids)
+
+        published, keys = {}, {}
+        for calendar_id in calendar_ids:
+            if cls._sync_token_changed(calendar_id):
+                continue
+            keys[calendar_id] = (calendar_id, today, sync_tokens[calendar_id])
+            data = cls._published_freebusy_cache.get(keys[calendar_id])
+            if data is not None:
+                published[calendar_id] = data
+        missing = [i for i in calendar_ids if i not in published]
+        if not missing:
+            return published
+
+        dtstart = datetime.datetime.combine(today, datetime.time())\
+            .replace(tzinfo=tzlocal)
+        dtend = dtstart + datetime.timedelta(days=config.getint('calendar',
+                'vfb_window', default=60))
+        vfreebusies = cls.freebusy_many(missing, dtstart, dtend)
         with Transaction().set_context(_check_access=False):
-            events = Event.search([
-                    ['OR',
-                        [('dtstart', '<=', dtstart),
-                            ('dtend', '>=', dtstart)],
-                        [('dtstart', '<=', dtend),
-                            ('dtend', '>=', dtend)],
-                        [('dtstart', '>=', dtstart),
-                            ('dtend', '<=', dtend)],
-                        [('dtstart', '>=', dtstart),
-                            ('dtstart', '<=', dtend),
-                            ('dtend', '=', None)]],
-                    ('parent', '=', None),
-                    ('rdates', '=', None),
-                    ('rrules', '=', None),
-                    ('exdates', '=', None),
-                    ('exrules', '=', None),
-                    ('occurences', '=', None),
-                    ('calendar', '=', calendar_id),
-                    ])
+            calendars = cls.browse(missing)
+        for calendar in calendars:
+            ical = vfreebusies[calendar.id]
+            ical.method.value = 'PUBLISH'
+            ical.vfreebusy.add('dtstamp').value = datetime.datetime.now(
+                tzutc)
+            ical.vfreebusy.add('uid').value = str(uuid.uuid4())
+            if calendar.owner.email:
+                ical.vfreebusy.add('organizer').value = \
+                    'mailto:' + calendar.owner.email
+            published[calendar.id] = ical.serialize()
+            if calendar.id in keys:
+                cls._published_freebusy_cache.set(keys[calendar.id],
+                    published[calendar.id])
+        return published
 
-        for event in events:
-            # Don't group freebusy as sunbird doesn't handle it
-            freebusy = ical.vfreebusy.add('freebusy')
-            freebusy.fbtype_param = event._fbtype
-            if event.dtstart.replace(tzinfo=tzlocal) >= dtstart:
-                freebusy_dtstart = event.dtstart.replace(tzinfo=tzlocal)
-            else:
-                freebusy_dtstart = dtstart
-            if event.dtend.replace(tzinfo=tzlocal) <= dtend:
-                freebusy_dtend = event.dtend.replace(tzinfo=tzlocal)
-            else:
-                freebusy_dtend = dtend
-            freebusy.value = [(
-                freebusy_dtstart.astimezone(tzutc),
-                freebusy_dtend.astimezone(tzutc))]
+    @classmethod
+    def _freebusy_periods(cls, calendar_ids, dtstart, dtend):
+        '''
+        Return a dictionary of the sorted lists of busy periods by
+        calendar_ids as tuples of (dtstart, dtend, fbtype) between the two
+        timezone aware dates
+        '''
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Instance = pool.get('calendar.event.instance')
+
+        periods = dict((i, []) for i in calendar_ids)
+
+        def add(calendar_id, period_dtstart, period_dtend, fbtype,
+                all_day=False):
+            if not all_day:
+                period_dtstart = max(period_dtstart, dtstart)
+                period_dtend = min(period_dtend, dtend)
+            periods[calendar_id].append((period_dtstart, period_dtend, fbtype))
 
         with Transaction().set_context(_check_access=False):
             events = Event.search([
+                    Event.overlap_domain(dtstart, dtend),
                     ('parent', '=', None),
-                    ('dtstart', '<=', dtend),
+                    ('is_recurrent', '=', False),
+                    ('calendar', 'in', calendar_ids),
+                    ])
+            instances = Instance.search([
+                    ('calendar', 'in', calendar_ids),
+                    ('dtstart', '<', dtend),
                     ['OR',
-                        ('rdates', '!=', None),
-                        ('rrules', '!=', None),
-                        ('exdates', '!=', None),
-                        ('exrules', '!=', None),
-                        ('occurences', '!=', None),
+                        ('dtend', '>', dtstart),
+                        ('dtstart', '>=', dtstart),
                         ],
-                    ('calendar', '=', calendar_id),
+                    ])
+            # Events which are not materialized from the start
+            heads = Event.search([
+                    ('parent', '=', None),
+                    ('dtstart', '<', _naive(dtend)),
+                    ('instances_from', '!=', None),
+                    ('instances_from', '>', _naive(dtstart)),
+                    ('calendar', 'in', calendar_ids),
+                    ])
+            # Events which are not materialized up to the end
+            tails = Event.search([
+                    ('parent', '=', None),
+                    ('dtstart', '<=', _naive(dtend)),
+                    ('instances_until', '!=', None),
+                    ('instances_until', '<', _naive(dtend)),
+                    ('calendar', 'in', calendar_ids),
                     ])
 
         for event in events:
-            event_ical = event.event2ical()
-            if event_ical.vevent.rruleset:
-                for freebusy_dtstart in event_ical.vevent.rruleset:
-                    if freebusy_dtstart.replace(tzinfo=tzlocal) > dtend:
-                        break
-                    if not event.dtend:
-                        freebusy_dtend = freebusy_dtstart
-                    else:
-                        freebusy_dtend = event.dtend.replace(tzinfo=tzlocal)\
-                            - event.dtstart.replace(tzinfo=tzlocal) \
-                            + freebusy_dtstart
-                    f_dtstart_tz = freebusy_dtstart.replace(tzinfo=tzlocal)
-                    f_dtend_tz = freebusy_dtend.replace(tzinfo=tzlocal)
-                    if not ((f_dtstart_tz <= dtstart
-                                and f_dtend_tz >= dtstart)
-                            or (f_dtstart_tz <= dtend
-                                and f_dtend_tz >= dtend)
-                            or (f_dtstart_tz >= dtstart
-                                and f_dtend_tz <= dtend)):
-                        continue
-                    freebusy_fbtype = event._fbtype
-                    all_day = event.all_day
-                    for occurence in event.occurences:
-                        if (occurence.recurrence.replace(tzinfo=tzlocal)
-                                == f_dtstart_tz):
-                            freebusy_dtstart = \
-                                occurence.dtstart.replace(tzinfo=tzlocal)
-                            if occurence.dtend:
-                                freebusy_dtend = occurence.dtend\
-                                    .replace(tzinfo=tzlocal)
-                            else:
-                                freebusy_dtend = freebusy_dtstart
-                            all_day = occurence.all_day
-                            freebusy_fbtype = occurence._fbtype
-                            break
-                    freebusy = ical.vfreebusy.add('freebusy')
-                    freebusy.fbtype_param = freebusy_fbtype
-                    if f_dtstart_tz <= dtstart:
-                        freebusy_dtstart = dtstart
-                    if f_dtend_tz >= dtend:
-                        freebusy_dtend = dtend
-                    if all_day:
-                        freebusy.value = [(
-                                f_dtstart_tz.astimezone(tzutc),
-                                f_dtend_tz.astimezone(tzutc),
-                                )]
-                    else:
-                        freebusy.value = [(
-                            freebusy_dtstart.astimezone(tzutc),
-                            freebusy_dtend.astimezone(tzutc))]
-        return ical
+            add(event.calendar.id, event.dtstart.replace(tzinfo=tzlocal),
+                (event.dtend or event.dtstart).replace(tzinfo=tzlocal),
+                event._fbtype)
+        for instance in instances:
+            add(instance.calendar.id, instance.dtstart.replace(tzinfo=tzlocal),
+                instance.dtend.replace(tzinfo=tzlocal), instance.fbtype,
+                instance.all_day)
+        for event in heads:
+            instances_from = event.instances_from.replace(tzinfo=tzlocal)
+            instances_until = None
+            if event.instances_until:
+                instances_until = event.instances_until.replace(
+                    tzinfo=tzlocal)
+            for recurrence, instance_dtstart, instance_dtend, all_day, \
+                    fbtype, _ in event.iter_instances(dtstart,
+                        min(dtend, instances_from)):
+                # The others are materialized or in the tail
+                if (instance_dtend > instances_from
+                        or (instances_until
+                            and recurrence > instances_until)):
+                    continue
+                add(event.calendar.id, instance_dtstart, instance_dtend,
+                    fbtype, all_day)
+        for event in tails:
+            instances_until = event.instances_until.replace(tzinfo=tzlocal)
+            for recurrence, instance_dtstart, instance_dtend, all_day, \
+                    fbtype, _ in event.iter_instances(dtstart, dtend):
+                if recurrence <= instances_until:
+                    continue
+                add(event.calendar.id, instance_dtstart, instance_dtend,
+                    fbtype, all_day)
+        for calendar_periods in periods.itervalues():
+            calendar_periods.sort()
+        return periods
+
+    @classmethod
+    def find_free_slots(cls, calendar_ids, duration, window_start, window_end,
+            working_hours=None, limit=10):
+        '''
+        Return the first limit slots as tuples of (dtstart, dtend) lasting
+        duration between the window dates where all the calendars are free
+        working_hours is a list of (weekday, start time, end time) in local
+        time to which the slots are restricted
+        '''
+        if not window_start.tzinfo:
+            window_start = window_start.replace(tzinfo=tzlocal)
+        if not window_end.tzinfo:
+            window_end = window_end.replace(tzinfo=tzlocal)
+        periods = cls._freebusy_periods_cached(calendar_ids, window_start,
+            window_end)
+        busy = heapq.merge(*[[p for p in periods[i] if p[2] != 'FREE']
+                for i in calendar_ids])
+
+        def free_periods():
+            dtstart = window_start
+            for busy_dtstart, busy_dtend, _ in busy:
+                if busy_dtstart > dtstart:
+                    yield dtstart, min(busy_dtstart, window_end)
+                dtstart = max(dtstart, busy_dtend)
+                if dtstart >= window_end:
+                    return
+            yield dtstart, window_end
+
+        def working_periods():
+            hours = sorted((start, end, weekday)
+                for weekday, start, end in working_hours)
+            for dtstart, dtend in free_periods():
+                day = dtstart.astimezone(tzlocal).date()
+                while day <= dtend.astimezone(tzlocal).date():
+                    for start, end, weekday in hours:
+                        if weekday != day.weekday():
+                            continue
+                        start = datetime.datetime.combine(day, start)\
+                            .replace(tzinfo=tzlocal)
+                        end = datetime.datetime.combine(day, end)\
+                            .replace(tzinfo=tzlocal)
+                        if start < dtend and end > dtstart:
+                            yield max(start, dtstart), min(end, dtend)
+                    day += datetime.timedelta(days=1)
+
+        slots = []
+        for dtstart, dtend in (working_periods() if working_hours
+                else free_periods()):
+            while dtstart + duration <= dtend and len(slots) < limit:
+                slots.append((dtstart, dtstart + duration))
+                dtstart += duration
+            if len(slots) >= limit:
+                break
+        return slots
+
+    @classmethod
+    def update_availability(cls, calendars, first=None):
+        '''
+        Rebuild the availability bitmaps of the calendars from first, by
+        default the current date, up to the horizon
+        '''
+        pool = Pool()
+        Availability = pool.get('calendar.calendar.availability')
+
+        today = _instance_start().date()
+        until = _instance_horizon().date()
+        with Transaction().set_context(_check_access=False):
+            Availability.delete(Availability.search([
+                        ('calendar', 'in', [c.id for c in calendars]),
+                        ['OR',
+                            ('date', '<', today),
+                            ('date', '>', until),
+                            ],
+                        ]))
+            cls.write(calendars, {
+                    'availability_until': until,
+                    })
+        Availability.update([(c.id, first or today, until)
+                for c in calendars])
+
+    @classmethod
+    def get_availability(cls, calendar_ids, first_date, last_date):
+        '''
+        Return a dictionary by calendar_ids of dictionaries by date and
+        fbtype of the availability bitmaps between the two dates
+        Each bit of a bitmap is a busy slot of the day
+        '''
+        pool = Pool()
+        Availability = pool.get('calendar.calendar.availability')
+
+        today = _instance_start().date()
+        result = dict((i, {}) for i in calendar_ids)
+        with Transaction().set_context(_check_access=False):
+            calendars = cls.browse(calendar_ids)
+            availabilities = Availability.search([
+                    ('calendar', 'in', calendar_ids),
+                    ('date', '>=', max(first_date, today)),
+                    ('date', '<=', last_date),
+                    ])
+        for availability in availabilities:
+            if availability.date > availability.calendar.availability_until:
+                continue
+            result[availability.calendar.id].setdefault(availability.date,
+                {})[availability.fbtype] = int(availability.bitmap, 16)
+
+        # Compute the days which are not stored
+        for calendar in calendars:
+            if calendar.availability_until:
+                bounds = [
+                    (first_date, today - datetime.timedelta(days=1)),
+                    (calendar.availability_until
+                        + datetime.timedelta(days=1), last_date),
+                    ]
+            else:
+                bounds = [(first_date, last_date)]
+            for first, last in bounds:
+                first, last = max(first, first_date), min(last, last_date)
+                if first > last:
+                    continue
+                dtstart = datetime.datetime.combine(first, datetime.time())\
+                    .replace(tzinfo=tzlocal)
+                dtend = datetime.datetime.combine(
+                    last + datetime.timedelta(days=1), datetime.time())\
+                    .replace(tzinfo=tzlocal)
+                periods = cls._freebusy_periods_cached([calendar.id],
+                    dtstart, dtend)
+                for date, bitmaps in _availability_bitmaps(
+                        periods[calendar.id]).iteritems():
+                    if first <= date <= last:
+                        result[calendar.id][date] = bitmaps
+        return result
+
+    @classmethod
+    def is_available(cls, calendar_ids, dtstart, dtend):
+        '''
+        Test if all the calendars have no busy slot between the two dates
+        The slots which are only partially covered are tested on the exact
+        freebusy periods
+        '''
+        if not dtstart.tzinfo:
+            dtstart = dtstart.replace(tzinfo=tzlocal)
+        if not dtend.tzinfo:
+            dtend = dtend.replace(tzinfo=tzlocal)
+        masks = _availability_bitmaps([(dtstart, dtend, 'BUSY')])
+
+        # The slots fully covered by the period
+        slot = 24 * 60 * 60 // AVAILABILITY_SLOTS
+        local_start = _naive(dtstart)
+        inner_start = datetime.datetime.combine(local_start.date(),
+            datetime.time())
+        inner_start += datetime.timedelta(seconds=slot
+            * -(-int((local_start - inner_start).total_seconds()) // slot))
+        local_end = _naive(dtend)
+        inner_end = datetime.datetime.combine(local_end.date(),
+            datetime.time())
+        inner_end += datetime.timedelta(seconds=slot
+            * (int((local_end - inner_end).total_seconds()) // slot))
+        if inner_start < inner_end:
+            inner_masks = _availability_bitmaps([
+                    (inner_start.replace(tzinfo=tzlocal),
+                        inner_end.replace(tzinfo=tzlocal), 'BUSY')])
+        else:
+            inner_masks = {}
+
+        availabilities = cls.get_availability(calendar_ids, min(masks),
+            max(masks))
+        boundaries = []
+        for calendar_id in calendar_ids:
+            for date, bitmaps in availabilities[calendar_id].iteritems():
+                busy = reduce(lambda x, y: x | y, bitmaps.itervalues(), 0)
+                if busy & inner_masks.get(date, {}).get('BUSY', 0):
+                    return False
+                if busy & masks.get(date, {}).get('BUSY', 0):
+                    boundaries.append(calendar_id)
+        if not boundaries:
+            return True
+
+        periods = cls._freebusy_periods_cached(sorted(set(boundaries)),
+            dtstart, dtend)
+        for calendar_periods in periods.itervalues():
+            for p_start, p_end, fbtype in calendar_periods:
+                if fbtype != 'FREE' and (p_start < dtend
+                        and (p_end > dtstart or p_start >= dtstart)):
+                    return False
+        return True
 
     @classmethod
     def post(cls, uri, data):
@@ -305,6 +917,22 @@ class Calendar(ModelSQL, ModelView):
                     dtend = ical.vfreebusy.dtend.value.astimezone(tzlocal)
                 else:
                     dtend = ical.vfreebusy.dtend.value
+            emails = {}
+            for attendee in ical.vfreebusy.attendee_list:
+                email = attendee.value
+                if attendee.value.lower().startswith('mailto:'):
+                    email = attendee.value[7:]
+                emails[attendee.value] = email
+            calendar_ids = {}
+            with Transaction().set_context(_check_access=False):
+                calendars = cls.search([
+                        ('owner.email', 'in', list(set(emails.values()))),
+                        ])
+            for calendar in calendars:
+                calendar_ids.setdefault(calendar.owner.email, calendar.id)
+            vfreebusies = cls.freebusy_many(list(set(calendar_ids.values())),
+                dtstart, dtend)
+
             for attendee in ical.vfreebusy.attendee_list:
                 resp = doc.createElement('C:response')
                 sr.appendChild(resp)
@@ -316,15 +944,11 @@ class Calendar(ModelSQL, ModelView):
                 resp.appendChild(recipient)
 
                 vfreebusy = None
-                email = attendee.value
-                if attendee.value.lower().startswith('mailto:'):
-                    email = attendee.value[7:]
-                with Transaction().set_context(_check_access=False):
-                    calendars = cls.search([
-                            ('owner.email', '=', email),
-                            ])
-                if calendars:
-                    vfreebusy = cls.freebusy(calendars[0].id, dtstart, dtend)
+                calendar_id = calendar_ids.get(emails[attendee.value])
+                if calendar_id:
+                    # Copy as the same calendar may be requested many times
+                    vfreebusy = vfreebusies[calendar_id].duplicate(
+                        vfreebusies[calendar_id])
                     vfreebusy.vfreebusy.add('dtstamp').value = \
                         ical.vfreebusy.dtstamp.value
                     vfreebusy.vfreebusy.add('uid').value = \
@@ -378,6 +1002,23 @@ class Category(ModelSQL, ModelView):
             ]
         cls._order.insert(0, ('name', 'ASC'))
 
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Collection = pool.get('webdav.collection')
+        super(Category, cls).write(*args)
+        # The renders of the events contain the name of the categories
+        actions = iter(args)
+        ids = [c.id for categories, values in zip(actions, actions)
+            if 'name' in values for c in categories]
+        if ids:
+            with Transaction().set_context(_check_access=False):
+                Event.store_renders(Event.search([
+                            ('categories', 'in', ids),
+                            ]))
+            Collection._ics_cache.clear()
+
 
 class Location(ModelSQL, ModelView):
     "Location"
@@ -393,6 +1034,23 @@ class Location(ModelSQL, ModelView):
             ]
         cls._order.insert(0, ('name', 'ASC'))
 
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Collection = pool.get('webdav.collection')
+        super(Location, cls).write(*args)
+        # The renders of the events contain the name of the location
+        actions = iter(args)
+        ids = [l.id for locations, values in zip(actions, actions)
+            if 'name' in values for l in locations]
+        if ids:
+            with Transaction().set_context(_check_access=False):
+                Event.store_renders(Event.search([
+                            ('location', 'in', ids),
+                            ]))
+            Collection._ics_cache.clear()
+
 
 class Event(ModelSQL, ModelView):
     "Event"
@@ -473,6 +1131,17 @@ class Event(ModelSQL, ModelView):
             'required': Bool(Eval('_parent_parent')),
             }, depends=['parent'])
     vevent = fields.Binary('vevent')
+    instances_from = fields.DateTime('Instances From', readonly=True,
+        help='The date from which the instances are materialized.')
+    instances_until = fields.DateTime('Instances Until', readonly=True,
+        help='The date up to which the instances are materialized.')
+    is_recurrent = fields.Boolean('Is Recurrent', readonly=True, select=True,
+        help='If the event has recurrence dates, rules or occurences.')
+    recurrence_until = fields.DateTime('Recurrence Until', readonly=True,
+        help='The end of the last instance if the recurrence has an end.')
+    sync_token = fields.Integer('Sync Token', readonly=True, select=True,
+        help='The sync token of the calendar at the last change.')
+    _rruleset_cache = StatsCache('calendar_event.rruleset', context=False)
 
     @classmethod
     def __setup__(cls):
@@ -484,6 +1153,11 @@ class Event(ModelSQL, ModelView):
         cls._error_messages.update({
                 'invalid_recurrence': 'Recurrence "%s" can not be recurrent.',
                 })
+        # The fields which change the instances of an event
+        cls._instances_fields = set(['calendar', 'all_day', 'dtstart',
+                'dtend', 'timezone', 'status', 'transp', 'parent',
+                'recurrence', 'rdates', 'rrules', 'exdates', 'exrules',
+                'occurences'])
 
     @classmethod
     def __register__(cls, module_name):
@@ -497,7 +1171,62 @@ class Event(ModelSQL, ModelView):
         if models_data:
             model_data, = models_data
             Rule.delete([Rule(model_data.db_id)])
-        return super(Event, cls).__register__(module_name)
+
+        TableHandler = backend.get('TableHandler')
+        cursor = Transaction().cursor
+        sql_table = cls.__table__()
+        migrate_is_recurrent = (
+            TableHandler.table_exist(cursor, cls._table)
+            and not TableHandler(cursor, cls, module_name).column_exist(
+                'is_recurrent'))
+
+        super(Event, cls).__register__(module_name)
+
+        # Migration from 3.4: add is_recurrent
+        if migrate_is_recurrent:
+            occurence = cls.__table__()
+            recurrent = Exists(occurence.select(occurence.id,
+                    where=occurence.parent == sql_table.id))
+            for name in ['rdate', 'exdate', 'rrule', 'exrule']:
+                child = Table('calendar_event_%s' % name)
+                recurrent |= Exists(child.select(child.id,
+                        where=child.event == sql_table.id))
+            cursor.execute(*sql_table.update(
+                    columns=[sql_table.is_recurrent],
+                    values=[True],
+                    where=(sql_table.parent == Null) & recurrent))
+
+        if backend.name() == 'postgresql':
+            cursor.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s',
+                ('calendar_event_period_index',))
+            if not cursor.fetchone():
+                cursor.execute('CREATE INDEX calendar_event_period_index '
+                    'ON "' + cls._table + '" USING GIST '
+                    '(TSRANGE("dtstart", GREATEST("dtstart", "dtend"), '
+                    '\'[]\'))')
+
+    @classmethod
+    def overlap_domain(cls, dtstart, dtend):
+        '''
+        Return a domain for the events which overlap the period
+        '''
+        table = cls.__table__()
+        if dtstart.tzinfo:
+            dtstart = dtstart.astimezone(tzlocal).replace(tzinfo=None)
+        if dtend.tzinfo:
+            dtend = dtend.astimezone(tzlocal).replace(tzinfo=None)
+        # An event without duration overlaps at the start of the period
+        where = ((Coalesce(table.dtend, table.dtstart) > dtstart)
+            | (table.dtstart >= dtstart))
+        if backend.name() == 'postgresql':
+            # Use the same expression as calendar_event_period_index
+            where &= RangeOverlap(
+                TsRange(table.dtstart,
+                    Greatest(table.dtstart, table.dtend), '[]'),
+                TsRange(dtstart, dtend, '[)'))
+        else:
+            where &= table.dtstart < dtend
+        return [('id', 'in', table.select(table.id, where=where))]
 
     @staticmethod
     def default_uuid():
@@ -515,6 +1244,10 @@ class Event(ModelSQL, ModelView):
     def default_transp():
         return 'opaque'
 
+    @staticmethod
+    def default_is_recurrent():
+        return False
+
     @staticmethod
     def timezones():
         return [(x, x) for x in pytz.common_timezones] + [('', '')]
@@ -537,6 +1270,24 @@ class Event(ModelSQL, ModelView):
                     or self.occurences:
                 self.raise_user_error('invalid_recurrence', (self.rec_name,))
 
+    @property
+    def _fbtype(self):
+        '''
+        Return the freebusy type for give transparent and status
+        '''
+        if self.transp == 'opaque':
+            if not self.status or self.status == 'confirmed':
+                fbtype = 'BUSY'
+            elif self.status == 'cancelled':
+                fbtype = 'FREE'
+            elif self.status == 'tentative':
+                fbtype = 'BUSY-TENTATIVE'
+            else:
+                fbtype = 'BUSY'
+        else:
+            fbtype = 'FREE'
+        return fbtype
+
     @classmethod
     def view_attributes(cls):
         return [('//page[@id="occurences"]', 'states', {
@@ -547,9 +1298,19 @@ class Event(ModelSQL, ModelView):
     def create(cls, vlist):
         pool = Pool()
         Calendar = pool.get('calendar.calendar')
+        Availability = pool.get('calendar.calendar.availability')
         Collection = pool.get('webdav.collection')
 
-        events = super(Event, cls).create(vlist)
+        with Transaction().set_context(_update_instances=False):
+            events = super(Event, cls).create(vlist)
+        cls._update_sync_token(events)
+        if any(e.parent for e in events):
+            # The occurences are compiled with their parent
+            cls._rruleset_cache.clear()
+        cls.update_instances(events)
+        Availability.update(
+            [e._availability_range() for e in events if not e.parent])
+        cls.store_renders(events)
         for event in events:
             if (event.calendar.owner
                     and (event.organizer == event.calendar.owner.email
@@ -628,18 +1389,35 @@ class Event(ModelSQL, ModelView):
     def write(cls, *args):
         pool = Pool()
         Calendar = pool.get('calendar.calendar')
+        Availability = pool.get('calendar.calendar.availability')
         Collection = pool.get('webdav.collection')
         cursor = Transaction().cursor
 
         actions = iter(args)
         args = []
+        # The previous parents lose their occurences
+        to_update = []
+        ranges = []
+        to_sync = []
+        removed = []
         for events, values in zip(actions, actions):
             values = values.copy()
             if 'sequence' in values:
                 del values['sequence']
+            if 'parent' in values:
+                to_update.extend(e.parent for e in events if e.parent)
+            if 'calendar' in values:
+                # The previous calendar loses the events
+                removed.extend((e.calendar.id, e.uuid) for e in events
+                    if not e.parent and e.calendar.id != values['calendar'])
+            to_sync.extend(events)
+            if set(values) & cls._instances_fields:
+                ranges.extend(e._availability_range()
+                    for e in events if not e.parent)
             args.extend((events, values))
 
-        super(Event, cls).write(*args)
+        with Transaction().set_context(_update_instances=False):
+            super(Event, cls).write(*args)
 
         table = cls.__table__()
         for sub_ids in grouped_slice(events, cursor.IN_MAX):
@@ -648,6 +1426,28 @@ class Event(ModelSQL, ModelView):
                     columns=[table.sequence],
                     values=[table.sequence + 1],
                     where=red_sql))
+        cls._update_sync_token(to_sync)
+        cls._add_tombstones(removed)
+
+        actions = iter(args)
+        for events, values in zip(actions, actions):
+            if set(values) & cls._instances_fields:
+                to_update.extend(events)
+            if 'calendar' in values:
+                # The previous calendar loses the events
+                Calendar._freebusy_cache.clear()
+                Calendar._published_freebusy_cache.clear()
+                Collection._ics_cache.clear()
+        if any(e.parent for e in to_update):
+            # The occurences are compiled with their parent
+            cls._rruleset_cache.clear()
+        cls.update_instances(to_update)
+        if ranges:
+            ranges.extend(e._availability_range()
+                for e in cls.browse([e.id for e in to_update])
+                if not e.parent)
+            Availability.update(ranges)
+        cls.store_renders(to_sync)
 
         actions = iter(args)
         for events, values in zip(actions, actions):
@@ -735,6 +1535,8 @@ class Event(ModelSQL, ModelView):
     def delete(cls, events):
         pool = Pool()
         Attendee = pool.get('calendar.event.attendee')
+        Calendar = pool.get('calendar.calendar')
+        Availability = pool.get('calendar.calendar.availability')
         Collection = pool.get('webdav.collection')
 
         for event in events:
@@ -778,10 +1580,407 @@ class Event(ModelSQL, ModelView):
                                 Attendee.write([attendee], {
                                         'status': 'declined',
                                         })
+        parents = [e.parent for e in events if e.parent]
+        ranges = [e._availability_range() for e in events if not e.parent]
+        ranges += [(p[0], p[1].date(), p[2].date())
+            for p in cls._instance_periods([e.id for e in events])]
+        removed = [(e.calendar.id, e.uuid) for e in events if not e.parent]
         super(Event, cls).delete(events)
+        if parents:
+            # The occurences are compiled with their parent
+            cls._rruleset_cache.clear()
+            # The parents which remain are changed
+            cls._update_sync_token(cls.search([
+                        ('id', 'in', [p.id for p in parents]),
+                        ]))
+        cls._add_tombstones(removed)
+        cls.update_instances(parents)
+        Availability.update(ranges)
+        # Deletion does not change the last modification of the calendars
+        Calendar._freebusy_cache.clear()
+        Calendar._published_freebusy_cache.clear()
+        Collection._ics_cache.clear()
         # Restart the cache for event
         Collection._event_cache.clear()
 
+    @classmethod
+    def _update_sync_token(cls, events):
+        '''
+        Set on the events the next sync token of their calendar
+        '''
+        Calendar = Pool().get('calendar.calendar')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+
+        calendar2ids = {}
+        for event in events:
+            calendar2ids.setdefault(event.calendar.id, []).append(event.id)
+        for calendar_id, event_ids in calendar2ids.iteritems():
+            sync_token = Calendar._next_sync_token(calendar_id)
+            for sub_ids in grouped_slice(event_ids):
+                cursor.execute(*table.update(
+                        columns=[table.sync_token],
+                        values=[sync_token],
+                        where=reduce_ids(table.id, sub_ids)))
+
+    @staticmethod
+    def _add_tombstones(removed):
+        '''
+        Record the list of (calendar id, uuid) removed from the calendars
+        '''
+        pool = Pool()
+        Calendar = pool.get('calendar.calendar')
+        Tombstone = pool.get('calendar.event.tombstone')
+
+        calendar2uuids = {}
+        for calendar_id, event_uuid in removed:
+            calendar2uuids.setdefault(calendar_id, set()).add(event_uuid)
+        to_create = []
+        for calendar_id, uuids in calendar2uuids.iteritems():
+            sync_token = Calendar._next_sync_token(calendar_id)
+            to_create.extend({
+                    'calendar': calendar_id,
+                    'uuid': event_uuid,
+                    'sync_token': sync_token,
+                    } for event_uuid in uuids)
+        if to_create:
+            with Transaction().set_context(_check_access=False):
+                Tombstone.create(to_create)
+
+    def compile_rruleset(self):
+        '''
+        Return the recurrence of the event compiled as a dictionary with the
+        dtstart in the timezone of the event, the duration, all_day, fbtype,
+        the keyword arguments of the rrules and exrules, the rdates, the
+        exdates and the occurences as tuples of (recurrence, dtstart, dtend,
+        all_day, fbtype, id) by recurrence
+        '''
+        key = (self.id, self.sequence, self.write_date or self.create_date)
+        compiled = self._rruleset_cache.get(key)
+        if compiled is not None:
+            return compiled
+
+        dtstart = self.dtstart.replace(tzinfo=tzlocal)
+        if self.dtend:
+            duration = self.dtend.replace(tzinfo=tzlocal) - dtstart
+        else:
+            duration = datetime.timedelta()
+        if not self.all_day and self.timezone:
+            # Expand in the timezone of the event to follow its wall clock
+            dtstart = dtstart.astimezone(
+                dateutil.tz.gettz(self.timezone) or tzlocal)
+        occurences = {}
+        for occurence in self.occurences:
+            recurrence = occurence.recurrence.replace(tzinfo=tzlocal)
+            occurence_dtstart = occurence.dtstart.replace(tzinfo=tzlocal)
+            if occurence.dtend:
+                occurence_dtend = occurence.dtend.replace(tzinfo=tzlocal)
+            else:
+                occurence_dtend = occurence_dtstart
+            occurences[recurrence] = (recurrence, occurence_dtstart,
+                occurence_dtend, occurence.all_day, occurence._fbtype,
+                occurence.id)
+        compiled = {
+            'dtstart': dtstart,
+            'duration': duration,
+            'all_day': self.all_day,
+            'fbtype': self._fbtype,
+            'rrules': [r.rule2kwargs(dtstart) for r in self.rrules],
+            'exrules': [r.rule2kwargs(dtstart) for r in self.exrules],
+            'rdates': [d.date2datetime(dtstart) for d in self.rdates],
+            'exdates': [d.date2datetime(dtstart) for d in self.exdates],
+            'occurences': occurences,
+            }
+        self._rruleset_cache.set(key, compiled)
+        return compiled
+
+    def get_rruleset(self, start=None):
+        '''
+        Return a dateutil rruleset built from the recurrence rules and dates
+        of the event
+        The rules are started as close as possible before start
+        '''
+        compiled = self.compile_rruleset()
+        rruleset = dateutil.rrule.rruleset()
+        # DTSTART is always the first instance
+        rruleset.rdate(compiled['dtstart'])
+        for kwargs in compiled['rrules']:
+            rruleset.rrule(dateutil.rrule.rrule(
+                    **_skip_periods(kwargs, start)))
+        for kwargs in compiled['exrules']:
+            rruleset.exrule(
+                dateutil.rrule.rrule(**_skip_periods(kwargs, start)))
+        for rdate in compiled['rdates']:
+            rruleset.rdate(rdate)
+        for exdate in compiled['exdates']:
+            rruleset.exdate(exdate)
+        return rruleset
+
+    def _iter_recurrences(self, start=None, end=None):
+        '''
+        Yield the timezone aware recurrences of the event from about start
+        to about end
+        '''
+        compiled = self.compile_rruleset()
+        if (len(compiled['rrules']) == 1
+                and not compiled['exrules'] and not compiled['rdates']
+                and _numpy_rrule(compiled['rrules'][0])):
+            dtstart = compiled['dtstart']
+            first = _datetime64(dtstart, dtstart.tzinfo)
+            exdates = numpy.array([_datetime64(e, dtstart.tzinfo)
+                    for e in compiled['exdates']], 'datetime64[s]')
+            # DTSTART is always the first instance
+            if not (exdates == first).any():
+                yield dtstart
+            for recurrences in _numpy_recurrences(
+                    compiled['rrules'][0], start, end):
+                recurrences = recurrences[(recurrences > first)
+                    & ~numpy.in1d(recurrences, exdates)]
+                for recurrence in recurrences.tolist():
+                    yield recurrence.replace(tzinfo=dtstart.tzinfo)
+            return
+        for recurrence in self.get_rruleset(start):
+            yield recurrence
+
+    def iter_instances(self, dtstart=None, dtend=None):
+        '''
+        Yield the instances of the recurrent event which overlap the period
+        as tuples of (recurrence, dtstart, dtend, all_day, fbtype,
+        occurence id) with timezone aware datetimes
+        '''
+        compiled = self.compile_rruleset()
+        duration = compiled['duration']
+        occurences = compiled['occurences']
+        # Occurences may move an instance from outside the period into it
+        start, end = dtstart, dtend
+        if dtstart is not None:
+            start = dtstart - duration
+        for recurrence, occurence_dtstart, occurence_dtend, _, _, _ \
+                in occurences.itervalues():
+            if ((dtstart is None or occurence_dtend >= dtstart)
+                    and (dtend is None or occurence_dtstart <= dtend)):
+                if start is not None:
+                    start = min(start, recurrence)
+                if end is not None:
+                    end = max(end, recurrence)
+        for recurrence in self._iter_recurrences(start, end):
+            recurrence = recurrence.astimezone(tzlocal)
+            if end is not None and recurrence > end:
+                break
+            instance = occurences.get(recurrence)
+            if instance is None:
+                instance = (recurrence, recurrence, recurrence + duration,
+                    compiled['all_day'], compiled['fbtype'], None)
+            # An instance without duration overlaps at the start
+            if ((dtstart is not None and instance[2] <= dtstart
+                        and instance[1] < dtstart)
+                    or (dtend is not None and instance[1] >= dtend)):
+                continue
+            yield instance
+
+    def _recurrence_until(self):
+        '''
+        Return the timezone aware end of the last instance of the recurrent
+        event or None if the recurrence has no end
+        '''
+        compiled = self.compile_rruleset()
+        lasts = [compiled['dtstart']] + compiled['rdates']
+        for kwargs in compiled['rrules']:
+            if kwargs.get('until'):
+                lasts.append(kwargs['until'])
+            elif kwargs.get('count'):
+                lasts.append(dateutil.rrule.rrule(**kwargs)[-1])
+            else:
+                return None
+        until = max(lasts) + compiled['duration']
+        for _, _, occurence_dtend, _, _, _ in \
+                compiled['occurences'].itervalues():
+            until = max(until, occurence_dtend)
+        return until
+
+    @classmethod
+    def update_instances(cls, events):
+        '''
+        Materialize the instances of the recurrent events which overlap the
+        window from its start up to the horizon
+        '''
+        pool = Pool()
+        Instance = pool.get('calendar.event.instance')
+        Availability = pool.get('calendar.calendar.availability')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        instance = Instance.__table__()
+
+        if Transaction().context.get('_update_instances', True) is False:
+            return
+        # The instances are stored on the parent of occurences
+        ids = set(e.parent.id if e.parent else e.id for e in events)
+        if not ids:
+            return
+        start, horizon = _instance_start(), _instance_horizon()
+
+        with Transaction().set_context(_check_access=False):
+            events = cls.search([
+                    ('id', 'in', list(ids)),
+                    ])
+            periods = cls._instance_periods(ids)
+            for sub_ids in grouped_slice(ids):
+                cursor.execute(*instance.delete(
+                        where=reduce_ids(instance.event, sub_ids)))
+            rows = []
+            for event in events:
+                instances_from = instances_until = recurrence_until = None
+                is_recurrent = bool(not event.parent
+                    and (event.rdates or event.rrules or event.exdates
+                        or event.exrules or event.occurences))
+                if is_recurrent:
+                    # The instances which end before are expanded on demand
+                    if min([event.dtstart] + [o.dtstart
+                                for o in event.occurences]) < _naive(start):
+                        instances_from = _naive(start)
+                    event_rows, instances_until = event._window_instances(
+                        start, horizon)
+                    rows.extend(event_rows)
+                    recurrence_until = event._recurrence_until()
+                    if recurrence_until:
+                        recurrence_until = _naive(recurrence_until)
+                if (instances_from != event.instances_from
+                        or instances_until != event.instances_until
+                        or is_recurrent != event.is_recurrent
+                        or recurrence_until != event.recurrence_until):
+                    cursor.execute(*table.update(
+                            columns=[table.instances_from,
+                                table.instances_until, table.is_recurrent,
+                                table.recurrence_until],
+                            values=[instances_from, instances_until,
+                                is_recurrent, recurrence_until],
+                            where=table.id == event.id))
+            Instance.store(rows)
+        # Only the instances which changed modify the availability
+        periods ^= set((r[1], r[3], r[4], r[5], r[6]) for r in rows)
+        Availability.update([(p[0], p[1].date(), p[2].date())
+                for p in periods])
+
+    def _window_instances(self, start, horizon, after=None):
+        '''
+        Return the list of instance rows of the recurrent event which overlap
+        the period from start up to the horizon and the date up to which they
+        are materialized or None if the recurrence ends before the horizon
+        If after is set, only the recurrences after it are returned
+        '''
+        rows = []
+        for (recurrence, dtstart, dtend, all_day, fbtype,
+                occurence_id) in self.iter_instances(
+                    max(start, after) if after else start):
+            if recurrence > horizon:
+                return rows, _naive(horizon)
+            if after is not None and recurrence <= after:
+                continue
+            rows.append((self.id, self.calendar.id, _naive(recurrence),
+                    _naive(dtstart), _naive(dtend), all_day, fbtype,
+                    occurence_id))
+        return rows, None
+
+    @classmethod
+    def update_instance_window(cls):
+        '''
+        Move the window of the materialized instances to the current date
+        The instances which end before the start are removed and those up to
+        the new horizon are added
+        The availability bitmaps are moved the same way
+        '''
+        pool = Pool()
+        Calendar = pool.get('calendar.calendar')
+        Instance = pool.get('calendar.event.instance')
+        Availability = pool.get('calendar.calendar.availability')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        instance = Instance.__table__()
+        availability = Availability.__table__()
+
+        start, horizon = _instance_start(), _instance_horizon()
+
+        cursor.execute(*instance.select(instance.event,
+                where=(instance.dtend <= _naive(start))
+                & (instance.dtstart < _naive(start)),
+                group_by=instance.event))
+        trimmed = [e for e, in cursor.fetchall()]
+        for sub_ids in grouped_slice(trimmed):
+            cursor.execute(*table.update(
+                    columns=[table.instances_from],
+                    values=[_naive(start)],
+                    where=reduce_ids(table.id, sub_ids)))
+        cursor.execute(*instance.delete(
+                where=(instance.dtend <= _naive(start))
+                & (instance.dtstart < _naive(start))))
+        cursor.execute(*availability.delete(
+                where=availability.date < start.date()))
+
+        with Transaction().set_context(_check_access=False):
+            events = cls.search([
+                    ('parent', '=', None),
+                    ('instances_until', '!=', None),
+                    ('instances_until', '<', _naive(horizon)),
+                    ])
+        rows, untils = [], {}
+        for event in events:
+            event_rows, instances_until = event._window_instances(start,
+                horizon, after=event.instances_until.replace(tzinfo=tzlocal))
+            rows.extend(event_rows)
+            untils.setdefault(instances_until, []).append(event.id)
+        for instances_until, event_ids in untils.iteritems():
+            for sub_ids in grouped_slice(event_ids):
+                cursor.execute(*table.update(
+                        columns=[table.instances_until],
+                        values=[instances_until],
+                        where=reduce_ids(table.id, sub_ids)))
+        Instance.store(rows)
+
+        with Transaction().set_context(_check_access=False):
+            calendars = Calendar.search([
+                    ['OR',
+                        ('availability_until', '=', None),
+                        ('availability_until', '<', horizon.date()),
+                        ],
+                    ])
+        availability_untils = {}
+        for calendar in calendars:
+            availability_untils.setdefault(calendar.availability_until,
+                []).append(calendar)
+        for availability_until, calendars in availability_untils.iteritems():
+            first = None
+            if availability_until:
+                first = availability_until + datetime.timedelta(days=1)
+            Calendar.update_availability(calendars, first=first)
+
+    @classmethod
+    def _instance_periods(cls, event_ids):
+        '''
+        Return the set of (calendar id, dtstart, dtend, all_day, fbtype) of
+        the stored instances of the events
+        '''
+        pool = Pool()
+        Instance = pool.get('calendar.event.instance')
+        cursor = Transaction().cursor
+        instance = Instance.__table__()
+
+        periods = set()
+        for sub_ids in grouped_slice(event_ids):
+            cursor.execute(*instance.select(instance.calendar,
+                    instance.dtstart, instance.dtend, instance.all_day,
+                    instance.fbtype,
+                    where=reduce_ids(instance.event, sub_ids)))
+            periods.update((c, s, e, bool(a), f)
+                for c, s, e, a, f in cursor.fetchall())
+        return periods
+
+    def _availability_range(self):
+        '''
+        Return the (calendar id, first date, last date) covered by the event
+        '''
+        return (self.calendar.id, self.dtstart.date(),
+            (self.dtend or self.dtstart).date())
+
     @classmethod
     def ical2values(cls, event_id, ical, calendar_id, vevent=None):
         '''
@@ -1041,6 +2240,179 @@ class Event(ModelSQL, ModelView):
         '''
         Return an iCalendar instance of vobject for event
         '''
+        return self.events2ical([self])[self.id]
+
+    @classmethod
+    def events2ical(cls, events):
+        '''
+        Return a dictionary of iCalendar instances of vobject by event id
+        The related records of the events and their occurences are read
+        once for all
+        '''
+        events = list(events)
+        occurences = cls._events_occurences(events)
+        related = cls._events_related([e.id for e in events] + [o.id
+                for p in occurences.itervalues() for o in p])
+
+        result = {}
+        for event in events:
+            ical = vobject.iCalendar()
+            ical.vevent_list = [event._event2vevent(related)]
+            for occurence in occurences.get(event.id, []):
+                ical.vevent_list.append(occurence._event2vevent(related))
+            result[event.id] = ical
+        return result
+
+    @classmethod
+    def events2ics(cls, events):
+        '''
+        Return a dictionary of serialized iCalendar by event id
+        '''
+        events = list(events)
+        occurences = cls._events_occurences(events)
+        vevents = cls.events2vevents(events + [o
+                for p in occurences.itervalues() for o in p])
+
+        result = {}
+        for event in events:
+            chunk, body = [ICAL_HEADER], []
+            tzids = set()
+            for record in [event] + occurences.get(event.id, []):
+                vevent, vtimezones = vevents[record.id]
+                for tzid, vtimezone in vtimezones:
+                    if tzid not in tzids:
+                        tzids.add(tzid)
+                        chunk.append(vtimezone)
+                body.append(vevent)
+            result[event.id] = ''.join(chunk + body + [ICAL_FOOTER])
+        return result
+
+    @classmethod
+    def events2vevents(cls, events):
+        '''
+        Return a dictionary of tuples (vevent, vtimezones) by event id with
+        the serialized vevent of the event without its occurences and the
+        list of (tzid, vtimezone) serialized that it uses
+        The vevents are rendered again only when the event has changed
+        since its rendering stored by calendar.event.render
+        '''
+        pool = Pool()
+        Render = pool.get('calendar.event.render')
+        cursor = Transaction().cursor
+        render = Render.__table__()
+
+        events = list(events)
+        keys = dict((e.id, e._render_key()) for e in events)
+        result = {}
+        for sub_ids in grouped_slice(keys.keys()):
+            cursor.execute(*render.select(render.event, render.key,
+                    render.vevent, render.vtimezone,
+                    where=reduce_ids(render.event, sub_ids)))
+            for event_id, key, vevent, vtimezone in cursor.fetchall():
+                if key == keys[event_id]:
+                    # The renders are stored as unicode
+                    result[event_id] = (vevent.encode('utf-8'),
+                        Render.split_vtimezone(vtimezone))
+
+        missing = [e for e in events if e.id not in result]
+        if missing:
+            result.update(cls._render_vevents(missing))
+        return result
+
+    @classmethod
+    def _render_vevents(cls, events):
+        '''
+        Return a dictionary of tuples (vevent, vtimezones) by event id like
+        events2vevents but without the stored renders
+        '''
+        related = cls._events_related([e.id for e in events])
+        result = {}
+        for event in events:
+            ical = vobject.iCalendar()
+            ical.vevent_list = [event._event2vevent(related)]
+            # Add the VTIMEZONE used by the vevent
+            ical.behavior.generateImplicitParameters(ical)
+            vtimezones = [(v.tzid.value, v.serialize())
+                for v in getattr(ical, 'vtimezone_list', [])]
+            result[event.id] = (ical.vevent.serialize(), vtimezones)
+        return result
+
+    def _render_key(self):
+        '''
+        Return the key of the render which changes with the event
+        '''
+        return '%s %s' % (self.sequence, self.write_date or self.create_date)
+
+    @classmethod
+    def store_renders(cls, events):
+        '''
+        Render the events and store the renders
+        It is done when the events are written so the read requests do not
+        write
+        '''
+        Render = Pool().get('calendar.event.render')
+
+        for sub_ids in grouped_slice([e.id for e in events]):
+            # The sequence is updated by SQL
+            sub_events = cls.browse(list(sub_ids))
+            vevents = cls._render_vevents(sub_events)
+            Render.store([(e.id, e._render_key(),
+                        vevents[e.id][0].decode('utf-8'),
+                        ''.join(v for _, v in vevents[e.id][1]).decode(
+                            'utf-8'))
+                    for e in sub_events])
+
+    @classmethod
+    def _events_occurences(cls, events):
+        '''
+        Return a dictionary of the lists of occurences by event id
+        '''
+        occurences = {}
+        for sub_ids in grouped_slice([e.id for e in events]):
+            for occurence in cls.search([
+                        ('parent', 'in', list(sub_ids)),
+                        ]):
+                occurences.setdefault(occurence.parent.id, []).append(
+                    occurence)
+        return occurences
+
+    @staticmethod
+    def _events_related(event_ids):
+        '''
+        Return a dictionary by name of the dictionaries of the lists of
+        related records by event id
+        '''
+        pool = Pool()
+        EventCategory = pool.get('calendar.event-calendar.category')
+        Attendee = pool.get('calendar.event.attendee')
+        Alarm = pool.get('calendar.event.alarm')
+        RDate = pool.get('calendar.event.rdate')
+        ExDate = pool.get('calendar.event.exdate')
+        RRule = pool.get('calendar.event.rrule')
+        ExRule = pool.get('calendar.event.exrule')
+
+        related = {}
+        for name, Model in (('categories', EventCategory),
+                ('attendees', Attendee),
+                ('alarms', Alarm),
+                ('rdates', RDate),
+                ('exdates', ExDate),
+                ('rrules', RRule),
+                ('exrules', ExRule)):
+            related[name] = {}
+            for sub_ids in grouped_slice(event_ids):
+                for record in Model.search([
+                            ('event', 'in', list(sub_ids)),
+                            ]):
+                    related[name].setdefault(record.event.id, []).append(
+                        record)
+        return related
+
+    def _event2vevent(self, related):
+        '''
+        Return a vevent instance of vobject for event using the dictionary
+        of related records by name and event id
+        '''
         if self.timezone:
             tzevent = pytz.timezone(self.timezone)
             tzevent = dateutil.tz.gettz(self.timezone)
@@ -1114,10 +2486,11 @@ class Event(ModelSQL, ModelView):
         if not hasattr(vevent, 'sequence'):
             vevent.add('sequence')
         vevent.sequence.value = str(self.sequence) or '0'
-        if self.categories:
+        categories = related['categories'].get(self.id, [])
+        if categories:
             if not hasattr(vevent, 'categories'):
                 vevent.add('categories')
-            vevent.categories.value = [x.name for x in self.categories]
+            vevent.categories.value = [x.category.name for x in categories]
         elif hasattr(vevent, 'categories'):
             del vevent.categories
         if not hasattr(vevent, 'class'):
@@ -1145,39 +2518,261 @@ class Event(ModelSQL, ModelView):
             del vevent.organizer
 
         vevent.attendee_list = []
-        for attendee in self.attendees:
+        for attendee in related['attendees'].get(self.id, []):
             vevent.attendee_list.append(attendee.attendee2attendee())
 
-        if self.rdates:
+        rdates = related['rdates'].get(self.id, [])
+        if rdates:
             vevent.add('rdate')
             vevent.rdate.value = []
-            for rdate in self.rdates:
+            for rdate in rdates:
                 vevent.rdate.value.append(rdate.date2date())
 
-        if self.exdates:
+        exdates = related['exdates'].get(self.id, [])
+        if exdates:
             vevent.add('exdate')
             vevent.exdate.value = []
-            for exdate in self.exdates:
+            for exdate in exdates:
                 vevent.exdate.value.append(exdate.date2date())
 
-        if self.rrules:
-            for rrule in self.rrules:
-                vevent.add('rrule').value = rrule.rule2rule()
+        for rrule in related['rrules'].get(self.id, []):
+            vevent.add('rrule').value = rrule.rule2rule()
 
-        if self.exrules:
-            for exrule in self.exrules:
-                vevent.add('exrule').value = exrule.rule2rule()
+        for exrule in related['exrules'].get(self.id, []):
+            vevent.add('exrule').value = exrule.rule2rule()
 
         vevent.valarm_list = []
-        for alarm in self.alarms:
+        for alarm in related['alarms'].get(self.id, []):
             valarm = alarm.alarm2valarm()
             if valarm:
                 vevent.valarm_list.append(valarm)
+        return vevent
 
-        for occurence in self.occurences:
-            oical = occurence.event2ical()
-            ical.vevent_list.append(oical.vevent)
-        return ical
+
+class EventInstance(ModelSQL):
+    'Event Instance'
+    __name__ = 'calendar.event.instance'
+    _rec_name = 'dtstart'
+    event = fields.Many2One('calendar.event', 'Event', ondelete='CASCADE',
+        required=True, select=True)
+    calendar = fields.Many2One('calendar.calendar', 'Calendar',
+        ondelete='CASCADE', required=True, select=True)
+    recurrence = fields.DateTime('Recurrence', required=True)
+    dtstart = fields.DateTime('Start Date', required=True, select=True)
+    dtend = fields.DateTime('End Date', required=True, select=True)
+    all_day = fields.Boolean('All Day')
+    fbtype = fields.Selection([
+            ('FREE', 'Free'),
+            ('BUSY', 'Busy'),
+            ('BUSY-TENTATIVE', 'Busy Tentative'),
+            ], 'Free/Busy Type', required=True)
+    occurence = fields.Many2One('calendar.event', 'Occurence',
+        ondelete='SET NULL')
+
+    @classmethod
+    def __setup__(cls):
+        super(EventInstance, cls).__setup__()
+        cls._order.insert(0, ('dtstart', 'ASC'))
+
+    @classmethod
+    def store(cls, rows):
+        '''
+        Insert the list of (event id, calendar id, recurrence, dtstart, dtend,
+        all_day, fbtype, occurence id)
+        It is done by SQL as a recurrence has many instances
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        user = Transaction().user
+
+        for sub_rows in grouped_slice(rows):
+            cursor.execute(*table.insert([table.create_uid,
+                        table.create_date, table.event, table.calendar,
+                        table.recurrence, table.dtstart, table.dtend,
+                        table.all_day, table.fbtype, table.occurence],
+                    [[user, CurrentTimestamp()] + list(r)
+                        for r in sub_rows]))
+
+
+class EventRender(ModelSQL):
+    'Event Render'
+    __name__ = 'calendar.event.render'
+    _rec_name = 'key'
+    event = fields.Many2One('calendar.event', 'Event', ondelete='CASCADE',
+        required=True, select=True)
+    key = fields.Char('Key', required=True,
+        help='The sequence and the last modification of the rendered event.')
+    vevent = fields.Text('VEvent', required=True)
+    vtimezone = fields.Text('VTimezone')
+
+    @classmethod
+    def __setup__(cls):
+        super(EventRender, cls).__setup__()
+        cls._sql_constraints = [
+            ('event_uniq', 'UNIQUE(event)',
+                'An event can have only one render.'),
+            ]
+
+    @staticmethod
+    def split_vtimezone(vtimezone):
+        '''
+        Return the list of (tzid, vtimezone) of the serialized vtimezones
+        encoded in UTF-8
+        '''
+        result = []
+        end = 'END:VTIMEZONE\r\n'
+        for vtimezone in (vtimezone or u'').encode('utf-8').split(end)[:-1]:
+            vtimezone += end
+            result.append(
+                (vobject.readOne(vtimezone).tzid.value, vtimezone))
+        return result
+
+    @classmethod
+    def store(cls, renders):
+        '''
+        Store the list of (event id, key, vevent, vtimezone) replacing the
+        previous renders of the events
+        '''
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        user = Transaction().user
+
+        for sub_renders in grouped_slice(renders):
+            sub_renders = list(sub_renders)
+            cursor.execute(*table.delete(where=reduce_ids(table.event,
+                        [r[0] for r in sub_renders])))
+            cursor.execute(*table.insert([table.create_uid,
+                        table.create_date, table.event, table.key,
+                        table.vevent, table.vtimezone],
+                    [[user, CurrentTimestamp()] + list(r)
+                        for r in sub_renders]))
+
+
+class EventTombstone(ModelSQL):
+    'Event Tombstone'
+    __name__ = 'calendar.event.tombstone'
+    _rec_name = 'uuid'
+    calendar = fields.Many2One('calendar.calendar', 'Calendar',
+        required=True, select=True, ondelete='CASCADE')
+    uuid = fields.Char('UUID', required=True, select=True)
+    sync_token = fields.Integer('Sync Token', required=True, select=True,
+        help='The sync token of the calendar at the removal.')
+
+
+class CalendarAvailability(ModelSQL):
+    'Calendar Availability'
+    __name__ = 'calendar.calendar.availability'
+    _rec_name = 'date'
+    calendar = fields.Many2One('calendar.calendar', 'Calendar',
+        ondelete='CASCADE', required=True, select=True)
+    date = fields.Date('Date', required=True, select=True)
+    fbtype = fields.Selection([
+            ('BUSY', 'Busy'),
+            ('BUSY-TENTATIVE', 'Busy Tentative'),
+            ], 'Free/Busy Type', required=True)
+    bitmap = fields.Char('Bitmap', required=True,
+        help='The hexadecimal bitmap of the busy slots of the day.')
+
+    @classmethod
+    def __register__(cls, module_name):
+        Calendar = Pool().get('calendar.calendar')
+
+        super(CalendarAvailability, cls).__register__(module_name)
+
+        # Migration from 3.6: store the availability of existing calendars
+        with Transaction().set_context(_check_access=False):
+            calendars = Calendar.search([
+                    ('availability_until', '=', None),
+                    ])
+        if calendars:
+            Calendar.update_availability(calendars)
+
+    @classmethod
+    def update(cls, ranges):
+        '''
+        Compute the availability bitmaps of the days touched by the list of
+        (calendar id, first date, last date) from the current date up to the
+        availability date of the calendars
+        Only the bitmaps which changed are written
+        '''
+        pool = Pool()
+        Calendar = pool.get('calendar.calendar')
+        cursor = Transaction().cursor
+        table = cls.__table__()
+        user = Transaction().user
+
+        if not ranges:
+            return
+        with Transaction().set_context(_check_access=False):
+            calendars = Calendar.search([
+                    ('id', 'in', list(set(r[0] for r in ranges))),
+                    ('availability_until', '!=', None),
+                    ])
+        untils = dict((c.id, c.availability_until) for c in calendars)
+        today = _instance_start().date()
+
+        dates = {}
+        for calendar_id, first, last in ranges:
+            if calendar_id not in untils:
+                continue
+            first = max(first, today)
+            last = min(last, untils[calendar_id])
+            calendar_dates = dates.setdefault(calendar_id, set())
+            while first <= last:
+                calendar_dates.add(first)
+                first += datetime.timedelta(days=1)
+
+        to_delete, to_create = [], []
+        for calendar_id, calendar_dates in dates.iteritems():
+            # The periods are selected only for the runs of touched days
+            runs = []
+            for date in sorted(calendar_dates):
+                if runs and runs[-1][1] + datetime.timedelta(days=1) == date:
+                    runs[-1][1] = date
+                else:
+                    runs.append([date, date])
+            bitmaps = {}
+            for first, last in runs:
+                dtstart = datetime.datetime.combine(first, datetime.time())\
+                    .replace(tzinfo=tzlocal)
+                dtend = datetime.datetime.combine(
+                    last + datetime.timedelta(days=1), datetime.time())\
+                    .replace(tzinfo=tzlocal)
+                periods = Calendar._freebusy_periods([calendar_id], dtstart,
+                    dtend)
+                for date, date_bitmaps in _availability_bitmaps(
+                        periods[calendar_id]).iteritems():
+                    if first <= date <= last:
+                        bitmaps[date] = date_bitmaps
+
+            stored = {}
+            for sub_dates in grouped_slice(sorted(calendar_dates)):
+                cursor.execute(*table.select(table.id, table.date,
+                        table.fbtype, table.bitmap,
+                        where=(table.calendar == calendar_id)
+                        & table.date.in_(list(sub_dates))))
+                for id_, date, fbtype, bitmap in cursor.fetchall():
+                    stored.setdefault(date, {})[fbtype] = (id_, bitmap)
+
+            for date in calendar_dates:
+                fbtypes = dict((f, '%x' % b)
+                    for f, b in bitmaps.get(date, {}).iteritems())
+                for fbtype, (id_, bitmap) in stored.get(date, {}).iteritems():
+                    if fbtypes.get(fbtype) == bitmap:
+                        del fbtypes[fbtype]
+                    else:
+                        to_delete.append(id_)
+                for fbtype, bitmap in fbtypes.iteritems():
+                    to_create.append((calendar_id, date, fbtype, bitmap))
+
+        for sub_ids in grouped_slice(to_delete):
+            cursor.execute(*table.delete(where=reduce_ids(table.id, sub_ids)))
+        for sub_rows in grouped_slice(to_create):
+            cursor.execute(*table.insert([table.create_uid,
+                        table.create_date, table.calendar, table.date,
+                        table.fbtype, table.bitmap],
+                    [[user, CurrentTimestamp()] + list(r)
+                        for r in sub_rows]))
 
 
 class EventCategory(ModelSQL):
@@ -1242,9 +2837,10 @@ class EventAlarm(AlarmMixin, ModelSQL, ModelView):
             if values.get('event'):
                 # Update write_date of event
                 to_write.append(values['event'])
+        alarms = super(EventAlarm, cls).create(vlist)
         if to_write:
             Event.write(Event.browse(to_write), {})
-        return super(EventAlarm, cls).create(vlist)
+        return alarms
 
     @classmethod
     def write(cls, *args):
@@ -1256,20 +2852,20 @@ class EventAlarm(AlarmMixin, ModelSQL, ModelView):
             events += [x.event for x in event_alarms]
             if values.get('event'):
                 events.append(Event(values['event']))
+        super(EventAlarm, cls).write(*args)
         if events:
             # Update write_date of event
             Event.write(events, {})
-        super(EventAlarm, cls).write(*args)
 
     @classmethod
     def delete(cls, event_alarms):
         pool = Pool()
         Event = pool.get('calendar.event')
         events = [x.event for x in event_alarms]
+        super(EventAlarm, cls).delete(event_alarms)
         if events:
             # Update write_date of event
             Event.write(events, {})
-        super(EventAlarm, cls).delete(event_alarms)
 
 
 class AttendeeMixin:
@@ -1375,9 +2971,9 @@ class EventAttendee(AttendeeMixin, ModelSQL, ModelView):
                 # Update write_date of event
                 to_write.append(values['event'])
 
+        event_attendees = super(EventAttendee, cls).create(vlist)
         if to_write:
             Event.write(Event.browse(to_write), {})
-        event_attendees = super(EventAttendee, cls).create(vlist)
         for event_attendee in event_attendees:
             event = event_attendee.event
             if (event.calendar.owner
@@ -1422,12 +3018,12 @@ class EventAttendee(AttendeeMixin, ModelSQL, ModelView):
                 del values['email']
             args.extend((event_attendees, values))
 
+        super(EventAttendee, cls).write(*args)
+
         if events:
             # Update write_date of event
             Event.write(events, {})
 
-        super(EventAttendee, cls).write(*args)
-
         for event_attendee in sum(args[::2], []):
             event = event_attendee.event
             if (event.calendar.owner
@@ -1461,9 +3057,6 @@ class EventAttendee(AttendeeMixin, ModelSQL, ModelView):
         Event = pool.get('calendar.event')
 
         events = [x.event for x in event_attendees]
-        if events:
-            # Update write_date of event
-            Event.write(events, {})
 
         for attendee in event_attendees:
             event = attendee.event
@@ -1512,6 +3105,10 @@ class EventAttendee(AttendeeMixin, ModelSQL, ModelView):
                                 })
         super(EventAttendee, cls).delete(event_attendees)
 
+        if events:
+            # Update write_date of event
+            Event.write(events, {})
+
 
 class DateMixin:
     _rec_name = 'datetime'
@@ -1553,6 +3150,17 @@ class DateMixin:
             # Convert to UTC as sunbird doesn't handle tzid
             return self.datetime.replace(tzinfo=tzlocal).astimezone(tzutc)
 
+    def date2datetime(self, dtstart):
+        '''
+        Return a timezone aware datetime for date matching the time of
+        dtstart
+        '''
+        if self.date:
+            return datetime.datetime.combine(self.datetime.date(),
+                dtstart.timetz())
+        else:
+            return self.datetime.replace(tzinfo=tzlocal)
+
 
 class EventRDate(DateMixin, ModelSQL, ModelView):
     'Recurrence Date'
@@ -1595,9 +3203,11 @@ class EventRDate(DateMixin, ModelSQL, ModelView):
             if values.get('event'):
                 # Update write_date of event
                 to_write.append(values['event'])
+        records = super(EventRDate, cls).create(vlist)
         if to_write:
             Event.write(Event.browse(to_write), {})
-        return super(EventRDate, cls).create(vlist)
+        Event.update_instances(Event.browse(to_write))
+        return records
 
     @classmethod
     def write(cls, *args):
@@ -1609,20 +3219,22 @@ class EventRDate(DateMixin, ModelSQL, ModelView):
             events += [x.event for x in event_rdates]
             if values.get('event'):
                 events.append(Event(values['event']))
+        super(EventRDate, cls).write(*args)
         if events:
             # Update write_date of event
             Event.write(events, {})
-        super(EventRDate, cls).write(*args)
+        Event.update_instances(events)
 
     @classmethod
     def delete(cls, event_rdates):
         pool = Pool()
         Event = pool.get('calendar.event')
         events = [x.event for x in event_rdates]
+        super(EventRDate, cls).delete(event_rdates)
         if events:
             # Update write_date of event
             Event.write(events, {})
-        super(EventRDate, cls).delete(event_rdates)
+        Event.update_instances(events)
 
 
 class EventExDate(EventRDate):
@@ -1844,6 +3456,39 @@ class RRuleMixin(Model):
                 res[field] = value
         return res
 
+    def rule2kwargs(self, dtstart):
+        '''
+        Return the keyword arguments of dateutil rrule for rule starting at
+        dtstart
+        '''
+        res = {
+            'freq': getattr(dateutil.rrule, self.freq.upper()),
+            'dtstart': dtstart,
+            'interval': self.interval or 1,
+            }
+        if self.until:
+            if self.until_date:
+                res['until'] = datetime.datetime.combine(self.until.date(),
+                    dtstart.timetz())
+            else:
+                res['until'] = self.until.replace(tzinfo=tzlocal)
+        elif self.count:
+            res['count'] = self.count
+        if self.wkst:
+            res['wkst'] = getattr(dateutil.rrule, self.wkst.upper())
+        if self.byday:
+            res['byweekday'] = []
+            for weekdaynum in self.byday.split(','):
+                weekday = getattr(dateutil.rrule, weekdaynum[-2:].upper())
+                if weekdaynum[:-2]:
+                    weekday = weekday(int(weekdaynum[:-2]))
+                res['byweekday'].append(weekday)
+        for field in ('bysecond', 'byminute', 'byhour', 'bymonthday',
+                'byyearday', 'byweekno', 'bymonth', 'bysetpos'):
+            if getattr(self, field):
+                res[field] = [int(x) for x in getattr(self, field).split(',')]
+        return res
+
     def rule2rule(self):
         '''
         Return a rule string for rule
@@ -1905,9 +3550,11 @@ class EventRRule(RRuleMixin, ModelSQL, ModelView):
             if values.get('event'):
                 # Update write_date of event
                 to_write.append(values['event'])
+        records = super(EventRRule, cls).create(vlist)
         if to_write:
             Event.write(Event.browse(to_write), {})
-        return super(EventRRule, cls).create(vlist)
+        Event.update_instances(Event.browse(to_write))
+        return records
 
     @classmethod
     def write(cls, *args):
@@ -1919,20 +3566,22 @@ class EventRRule(RRuleMixin, ModelSQL, ModelView):
             events += [x.event for x in event_rrules]
             if values.get('event'):
                 events.append(Event(values['event']))
+        super(EventRRule, cls).write(*args)
         if events:
             # Update write_date of event
             Event.write(events, {})
-        super(EventRRule, cls).write(*args)
+        Event.update_instances(events)
 
     @classmethod
     def delete(cls, event_rrules):
         pool = Pool()
         Event = pool.get('calendar.event')
         events = [x.event for x in event_rrules]
+        super(EventRRule, cls).delete(event_rrules)
         if events:
             # Update write_date of event
             Event.write(events, {})
-        super(EventRRule, cls).delete(event_rrules)
+        Event.update_instances(events)
 
 
 class EventExRule(EventRRule):
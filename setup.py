@@ -95,6 +95,7 @@ setup(name=name,
     install_requires=requires,
     extras_require={
         'test': ['caldav'],
+        'numpy': ['numpy'],
         },
     zip_safe=False,
     entry_points="""
@@ -1,14 +1,1133 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import datetime
+import time
 import unittest
+import dateutil.tz
+import vobject
+import xml.dom.minidom
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, POOL, DB_NAME, USER, \
+    CONTEXT
+from trytond.transaction import Transaction
+from trytond.modules.calendar import calendar_
 
 
 class CalendarTestCase(ModuleTestCase):
     'Test Calendar module'
     module = 'calendar'
 
+    def setUp(self):
+        super(CalendarTestCase, self).setUp()
+        self.user = POOL.get('res.user')
+        self.calendar = POOL.get('calendar.calendar')
+        self.event = POOL.get('calendar.event')
+        self.exdate = POOL.get('calendar.event.exdate')
+
+    def create_calendar(self):
+        'Create a calendar owned by admin'
+        admin, = self.user.search([('login', '=', 'admin')])
+        self.user.write([admin], {'email': 'admin@example.com'})
+        calendar, = self.calendar.create([{
+                    'name': 'admin',
+                    'owner': admin.id,
+                    }])
+        return calendar
+
+    def read_rollback(self, read):
+        '''
+        Return the results of read on a committed calendar in a transaction
+        which is rolled back, in a transaction which commits an event with
+        the same sync token and in a new transaction
+        '''
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            calendar_id = self.create_calendar().id
+            transaction.cursor.commit()
+        day = datetime.datetime.combine(
+            datetime.date.today() + datetime.timedelta(days=1),
+            datetime.time())
+        results = []
+        try:
+            for summary, hour in [('Rollback', 9), ('Commit', 15)]:
+                with Transaction().start(DB_NAME, USER,
+                        context=CONTEXT) as transaction:
+                    self.event.create([{
+                                'calendar': calendar_id,
+                                'summary': summary,
+                                'dtstart': day.replace(hour=hour),
+                                'dtend': day.replace(hour=hour + 1),
+                                }])
+                    results.append(read(self.calendar(calendar_id)))
+                    if summary == 'Commit':
+                        transaction.cursor.commit()
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                results.append(read(self.calendar(calendar_id)))
+        finally:
+            with Transaction().start(DB_NAME, USER,
+                    context=CONTEXT) as transaction:
+                self.calendar.delete(self.calendar.search([]))
+                transaction.cursor.commit()
+        return results
+
+    def dav_request(self, method, path, headers='', body='',
+            version='HTTP/1.1'):
+        'Return the raw response of the WebDAV handler to the request'
+        import mimetools
+        import StringIO
+        from trytond.protocols import webdav
+        from trytond.protocols.webdav import WebDAVAuthRequestHandler, \
+            TrytonDAVInterface, setupConfig
+
+        class Handler(WebDAVAuthRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def __init__(self, path, headers, body=''):
+                self.path = path
+                self.headers = mimetools.Message(
+                    StringIO.StringIO(headers + '\r\n'))
+                self.rfile = StringIO.StringIO(body)
+                self.wfile = StringIO.StringIO()
+                self.request_version = version
+                self.requestline = ''
+                self.client_address = ('localhost', 0)
+                self._config = setupConfig()
+                self.IFACE_CLASS = TrytonDAVInterface('localhost', 8080)
+                self.IFACE_CLASS.baseurl = ''
+
+            def log_request(self, *args):
+                pass
+
+        webdav.CACHE.clear()
+        handler = Handler('/%s/%s' % (DB_NAME, path), headers, body)
+        getattr(handler, 'do_' + method)()
+        return handler.wfile.getvalue()
+
+    def test0010open_recurrence_write(self):
+        'Test write on open-ended recurrent event'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendar = self.create_calendar()
+            dtstart = datetime.datetime.now().replace(hour=9, minute=0,
+                second=0, microsecond=0)
+            event, = self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Weekly',
+                        'dtstart': dtstart,
+                        'rrules': [('create', [{
+                                        'freq': 'weekly',
+                                        }])],
+                        }])
+            values, = self.event.read([event.id], ['instances_until'])
+            self.assertTrue(values['instances_until'])
+            self.assertEqual(values['instances_until'].microsecond, 0)
+            self.exdate.create([{
+                        'event': event.id,
+                        'datetime': dtstart + datetime.timedelta(days=7),
+                        }])
+            self.event.write([event], {'summary': 'Meeting'})
+
+    def test0020instance_window(self):
+        'Test the window of the materialized instances'
+        Instance = POOL.get('calendar.event.instance')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendar = self.create_calendar()
+            event, = self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Daily',
+                        'dtstart': datetime.datetime(2020, 1, 1, 9),
+                        'dtend': datetime.datetime(2020, 1, 1, 10),
+                        'rrules': [('create', [{
+                                        'freq': 'daily',
+                                        }])],
+                        }])
+            start = datetime.datetime.combine(datetime.date.today(),
+                datetime.time())
+            values, = self.event.read([event.id],
+                ['instances_from', 'instances_until'])
+            self.assertEqual(values['instances_from'], start)
+            instances = Instance.search([('event', '=', event.id)])
+            self.assertTrue(all(i.dtend > start for i in instances))
+            self.assertTrue(len(instances) <= (values['instances_until']
+                    - start).days + 1)
+
+            tzlocal = dateutil.tz.tzlocal()
+
+            def periods(dtstart, dtend):
+                return self.calendar._freebusy_periods([calendar.id],
+                    dtstart.replace(tzinfo=tzlocal),
+                    dtend.replace(tzinfo=tzlocal))[calendar.id]
+            # Before the window
+            self.assertEqual(len(periods(datetime.datetime(2020, 1, 6),
+                        datetime.datetime(2020, 1, 9))), 3)
+            # Over the start of the window
+            self.assertEqual(len(periods(start - datetime.timedelta(days=3),
+                        start + datetime.timedelta(days=3))), 6)
+
+            # Move the horizon back to test the extension
+            cursor = Transaction().cursor
+            table = self.event.__table__()
+            instance = Instance.__table__()
+            until = values['instances_until'] - datetime.timedelta(days=10)
+            cursor.execute(*table.update([table.instances_until], [until],
+                    where=table.id == event.id))
+            cursor.execute(*instance.delete(
+                    where=instance.recurrence > until))
+            self.event.update_instance_window()
+            self.assertEqual(
+                len(Instance.search([('event', '=', event.id)])),
+                len(instances))
+            values, = self.event.read([event.id], ['instances_until'])
+            self.assertTrue(values['instances_until'] > until)
+
+    def test0030prop_filter_text_match(self):
+        'Test text-match of prop-filter with wildcards'
+        from trytond.modules.calendar.webdav import _prop_filter_domain
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendar = self.create_calendar()
+            lunch, l_nch = self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': summary,
+                        'dtstart': datetime.datetime(2026, 10, 1, 12),
+                        } for summary in ['Lunch', 'L_nch']])
+
+            def search(value, negate=False, collation='i;ascii-casemap'):
+                prop_filter = xml.dom.minidom.parseString(
+                    '<C:prop-filter xmlns:C="urn:ietf:params:xml:ns:caldav" '
+                    'name="SUMMARY"><C:text-match collation="%s" '
+                    'negate-condition="%s">%s</C:text-match>'
+                    '</C:prop-filter>' % (collation,
+                        'yes' if negate else 'no', value)).documentElement
+                return self.event.search(_prop_filter_domain(prop_filter))
+            self.assertEqual(search('L_nch'), [l_nch])
+            self.assertEqual(search('L_nch', negate=True), [lunch])
+            self.assertEqual(search('%'), [])
+            self.assertEqual(search('%', negate=True), [lunch, l_nch])
+            self.assertEqual(search('l_NCH'), [l_nch])
+            self.assertEqual(search('l_NCH', collation='i;octet'), [])
+            self.assertEqual(search('unc'), [lunch])
+
+    def test0040freebusy_cache(self):
+        'Test the cache of free/busy periods'
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendar = self.create_calendar()
+            tzlocal = dateutil.tz.tzlocal()
+            dtstart = datetime.datetime(2026, 10, 1, tzinfo=tzlocal)
+            dtend = datetime.datetime(2026, 11, 1, tzinfo=tzlocal)
+
+            def periods():
+                return self.calendar._freebusy_periods_cached([calendar.id],
+                    dtstart, dtend)[calendar.id]
+            self.assertEqual(periods(), [])
+            event, = self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Meeting',
+                        'dtstart': datetime.datetime(2026, 10, 5, 9),
+                        'dtend': datetime.datetime(2026, 10, 5, 10),
+                        }])
+            self.assertEqual([p[0].hour for p in periods()], [9])
+            self.event.write([event], {
+                    'dtstart': datetime.datetime(2026, 10, 5, 11),
+                    'dtend': datetime.datetime(2026, 10, 5, 12),
+                    })
+            self.assertEqual([p[0].hour for p in periods()], [11])
+            self.event.delete([event])
+            self.assertEqual(periods(), [])
+
+    def test0045freebusy_cache_rollback(self):
+        'Test the cache of free/busy periods after a rollback'
+        tzlocal = dateutil.tz.tzlocal()
+        dtstart = datetime.datetime.combine(datetime.date.today(),
+            datetime.time()).replace(tzinfo=tzlocal)
+        dtend = dtstart + datetime.timedelta(days=2)
+
+        def read(calendar):
+            return [p[0].hour for p in self.calendar._freebusy_periods_cached(
+                    [calendar.id], dtstart, dtend)[calendar.id]]
+        self.assertEqual(self.read_rollback(read), [[9], [15], [15]])
+
+    def test0050ics_cache(self):
+        'Test the cache of the calendar .ics'
+        Collection = POOL.get('webdav.collection')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendar = self.create_calendar()
+            uri = 'Calendars/%s.ics' % calendar.name
+            self.assertNotIn('VEVENT', Collection.get_data(uri))
+            event, = self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Meeting',
+                        'dtstart': datetime.datetime(2026, 10, 5, 9),
+                        }])
+            self.assertIn('SUMMARY:Meeting', Collection.get_data(uri))
+            self.event.write([event], {'summary': 'Lunch'})
+            data = Collection.get_data(uri)
+            self.assertIn('SUMMARY:Lunch', data)
+            self.assertEqual(Collection.get_data(uri), data)
+
+    def test0055ics_cache_rollback(self):
+        'Test the cache of the calendar .ics after a rollback'
+        Collection = POOL.get('webdav.collection')
+
+        def read(calendar):
+            data = Collection.get_data('Calendars/%s.ics' % calendar.name)
+            return [s for s in ['Rollback', 'Commit']
+                if 'SUMMARY:%s' % s in data]
+        self.assertEqual(self.read_rollback(read),
+            [['Rollback'], ['Commit'], ['Commit']])
+
+    def test0060published_freebusy(self):
+        'Test the published free/busy'
+        Collection = POOL.get('webdav.collection')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendar = self.create_calendar()
+            uri = 'Calendars/%s.vfb' % calendar.name
+            today = datetime.date.today()
+            midnight = time.mktime(today.timetuple())
+            self.assertEqual(Collection.get_lastmodified(uri), midnight)
+            self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Meeting',
+                        'dtstart': datetime.datetime.combine(
+                            today + datetime.timedelta(days=1),
+                            datetime.time(9)),
+                        }])
+            lastmodified = Collection.get_lastmodified(uri)
+            self.assertTrue(lastmodified >= midnight)
+            self.assertEqual(Collection.get_lastmodified(uri), lastmodified)
+            data = Collection.get_data(uri)
+            self.assertIn('METHOD:PUBLISH', data)
+            self.assertIn('FREEBUSY', data)
+
+    def test0065published_freebusy_rollback(self):
+        'Test the cache of the published free/busy after a rollback'
+        Collection = POOL.get('webdav.collection')
+        tzlocal = dateutil.tz.tzlocal()
+
+        def read(calendar):
+            ical = vobject.readOne(
+                Collection.get_data('Calendars/%s.vfb' % calendar.name))
+            return [p[0].astimezone(tzlocal).hour
+                for f in ical.vfreebusy.contents.get('freebusy', [])
+                for p in f.value]
+        self.assertEqual(self.read_rollback(read), [[9], [15], [15]])
+
+    def test0070event_render(self):
+        'Test the stored renders of the events'
+        Render = POOL.get('calendar.event.render')
+        Attendee = POOL.get('calendar.event.attendee')
+        Category = POOL.get('calendar.category')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendar = self.create_calendar()
+            category, = Category.create([{'name': 'Work'}])
+            event, = self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Meeting',
+                        'dtstart': datetime.datetime(2026, 10, 5, 9),
+                        'organizer': 'admin@example.com',
+                        'categories': [('add', [category.id])],
+                        }])
+
+            def vevent():
+                render, = Render.search([('event', '=', event.id)])
+                return Render.read([render.id], ['vevent'])[0]['vevent']
+            render, = Render.search([])
+            ics = self.event.events2ics([event])[event.id]
+            self.assertIn(vevent(), ics)
+            # A second render reuses the stored row
+            self.assertEqual(self.event.events2ics([event])[event.id], ics)
+            self.assertEqual(Render.search([]), [render])
+
+            self.event.write([event], {'summary': 'Lunch'})
+            self.assertEqual(Render.search_count([]), 1)
+            self.assertIn('SUMMARY:Lunch', vevent())
+            Attendee.create([{
+                        'event': event.id,
+                        'email': 'foo@example.com',
+                        }])
+            self.assertIn('foo@example.com', vevent())
+            Category.write([category], {'name': 'Office'})
+            self.assertIn('CATEGORIES:Office', vevent())
+            self.assertEqual(vevent() + 'END:VCALENDAR\r\n',
+                self.event.events2ics([event])[event.id][-len(vevent())
+                    - len('END:VCALENDAR\r\n'):])
+
+            # The stored renders are unicode but rendered as UTF-8
+            self.event.write([event], {'summary': u'R\xe9union'})
+            self.assertIn(u'SUMMARY:R\xe9union', vevent())
+            event = self.event(event.id)
+            self.assertEqual(self.event.events2vevents([event])[event.id],
+                self.event._render_vevents([event])[event.id])
+
+    def test0075events2ical(self):
+        'Test the batched iCalendar of events'
+        Category = POOL.get('calendar.category')
+        Location = POOL.get('calendar.location')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendar = self.create_calendar()
+            category, = Category.create([{'name': 'Work'}])
+            location, = Location.create([{'name': 'Office'}])
+            day = datetime.datetime(2026, 10, 5)
+            weekly, single, dated = self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Weekly',
+                        'dtstart': day.replace(hour=9),
+                        'dtend': day.replace(hour=10),
+                        'organizer': 'admin@example.com',
+                        'categories': [('add', [category.id])],
+                        'location': location.id,
+                        'attendees': [('create', [{
+                                        'email': 'foo@example.com',
+                                        'status': 'accepted',
+                                        }])],
+                        'rrules': [('create', [{
+                                        'freq': 'weekly',
+                                        'count': 5,
+                                        }])],
+                        'exdates': [('create', [{
+                                        'datetime': day.replace(hour=9)
+                                        + datetime.timedelta(days=14),
+                                        }])],
+                        }, {
+                        'calendar': calendar.id,
+                        'summary': 'Single',
+                        'dtstart': day.replace(hour=11),
+                        }, {
+                        'calendar': calendar.id,
+                        'summary': 'Dated',
+                        'dtstart': day.replace(hour=14),
+                        'dtend': day.replace(hour=15),
+                        'organizer': 'admin@example.com',
+                        'attendees': [('create', [{
+                                        'email': 'bar@example.com',
+                                        }])],
+                        'rdates': [('create', [{
+                                        'datetime': day.replace(hour=14)
+                                        + datetime.timedelta(days=1),
+                                        }])],
+                        }])
+            self.event.write([weekly], {
+                    'occurences': [('create', [{
+                                    'calendar': calendar.id,
+                                    'uuid': weekly.uuid,
+                                    'summary': 'Moved',
+                                    'dtstart': day.replace(hour=16)
+                                    + datetime.timedelta(days=7),
+                                    'recurrence': day.replace(hour=9)
+                                    + datetime.timedelta(days=7),
+                                    }])],
+                    })
+            events = self.event.browse([weekly.id, single.id, dated.id])
+            icals = self.event.events2ical(events)
+            self.assertEqual(sorted(icals), sorted(e.id for e in events))
+            icss = self.event.events2ics(events)
+            for event in events:
+                ical = icals[event.id]
+                self.assertEqual(ical.serialize(),
+                    self.event.events2ical([event])[event.id].serialize())
+                self.assertEqual(ical.serialize(), icss[event.id])
+            self.assertEqual([len(icals[e.id].vevent_list) for e in events],
+                [2, 1, 1])
+            self.assertEqual(icals[weekly.id].vevent.attendee.value.lower(),
+                'mailto:foo@example.com')
+            self.assertEqual(icals[dated.id].vevent.attendee.value.lower(),
+                'mailto:bar@example.com')
+            self.assertFalse(hasattr(icals[single.id].vevent, 'attendee'))
+            self.assertFalse(hasattr(icals[single.id].vevent, 'categories'))
+
+    def test0080match_etag(self):
+        'Test the comparison of entity tags'
+        from trytond.modules.calendar.caldav import _match_etag
+
+        class Interface(object):
+            def exists(self, uri):
+                return uri == 'event'
+
+            def get_prop(self, uri, namespace, name):
+                return '"1-0-1"'
+        dc = Interface()
+        self.assertEqual(_match_etag('"1-0-1"', dc, 'event'),
+            (True, '"1-0-1"'))
+        self.assertEqual(_match_etag('"2", "1-0-1"', dc, 'event'),
+            (True, '"1-0-1"'))
+        self.assertEqual(_match_etag('W/"1-0-1"', dc, 'event'),
+            (False, '"1-0-1"'))
+        self.assertEqual(_match_etag('W/"1-0-1"', dc, 'event', weak=True),
+            (True, '"1-0-1"'))
+        self.assertEqual(_match_etag('*', dc, 'event'), (True, '"1-0-1"'))
+        self.assertEqual(_match_etag('*', dc, 'missing'), (False, None))
+
+    def test0090time_range_boundaries(self):
+        'Test the events at the boundaries of a time-range'
+        from trytond.modules.calendar.webdav import _comp_filter_domain
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendar = self.create_calendar()
+            zero, before, recurrent = self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Zero',
+                        'dtstart': datetime.datetime(2026, 10, 1),
+                        }, {
+                        'calendar': calendar.id,
+                        'summary': 'Before',
+                        'dtstart': datetime.datetime(2026, 9, 30, 23),
+                        'dtend': datetime.datetime(2026, 10, 1),
+                        }, {
+                        'calendar': calendar.id,
+                        'summary': 'Recurrent',
+                        'dtstart': datetime.datetime(2026, 9, 24),
+                        'rrules': [('create', [{
+                                        'freq': 'weekly',
+                                        'count': 2,
+                                        }])],
+                        }])
+            dtstart = datetime.datetime(2026, 10, 1)
+            dtend = datetime.datetime(2026, 11, 1)
+            self.assertEqual(self.event.search(
+                    _comp_filter_domain(dtstart, dtend, calendar.id)),
+                [zero, recurrent])
+
+            tzlocal = dateutil.tz.tzlocal()
+            periods = self.calendar._freebusy_periods([calendar.id],
+                dtstart.replace(tzinfo=tzlocal),
+                dtend.replace(tzinfo=tzlocal))[calendar.id]
+            self.assertEqual([p[0].replace(tzinfo=None) for p in periods],
+                [dtstart, dtstart])
+
+    def test0095coalesce_freebusy(self):
+        'Test the coalescence of the free/busy periods'
+        tzlocal = dateutil.tz.tzlocal()
+        day = datetime.datetime(2026, 10, 5)
+        periods = [
+            ('BUSY-TENTATIVE', 10, 13),
+            ('BUSY', 13, 15),
+            ('BUSY', 9, 10),
+            ('FREE', 9, 10),
+            ('BUSY', 17, 18),
+            ('BUSY', 12, 14),
+            ('BUSY', 10, 11),
+            ('BUSY', 16, 20),
+            ]
+        expected = {
+            'BUSY': [(9, 11), (12, 15), (16, 20)],
+            'BUSY-TENTATIVE': [(10, 13)],
+            'FREE': [(9, 10)],
+            }
+
+        def hours(coalesced):
+            return dict((fbtype, [(s.astimezone(tzlocal).hour,
+                                e.astimezone(tzlocal).hour)
+                            for s, e in fbtype_periods])
+                for fbtype, fbtype_periods in coalesced.iteritems())
+        self.assertEqual(hours(self.calendar._coalesce_periods([
+                        (day.replace(hour=s, tzinfo=tzlocal),
+                            day.replace(hour=e, tzinfo=tzlocal), fbtype)
+                        for fbtype, s, e in periods])), expected)
+
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendar = self.create_calendar()
+            self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': fbtype,
+                        'dtstart': day.replace(hour=s),
+                        'dtend': day.replace(hour=e),
+                        'status': {
+                            'BUSY-TENTATIVE': 'tentative',
+                            'FREE': 'cancelled',
+                            }.get(fbtype, 'confirmed'),
+                        } for fbtype, s, e in periods])
+            dtstart = day.replace(tzinfo=tzlocal)
+            dtend = dtstart + datetime.timedelta(days=1)
+            ical = self.calendar.freebusy(calendar.id, dtstart, dtend,
+                coalesce=True)
+            freebusy = ical.vfreebusy.contents['freebusy']
+            self.assertEqual([f.fbtype_param for f in freebusy],
+                sorted(expected))
+            self.assertEqual(hours(dict((f.fbtype_param, f.value)
+                        for f in freebusy)), expected)
+            ical = self.calendar.freebusy(calendar.id, dtstart, dtend,
+                coalesce=False)
+            self.assertEqual(len(ical.vfreebusy.contents['freebusy']),
+                len(periods))
+
+    def test0097freebusy_many(self):
+        'Test the batched free/busy of many calendars'
+        tzlocal = dateutil.tz.tzlocal()
+        day = datetime.datetime(2026, 10, 5)
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendars = [self.create_calendar()]
+            for login in ['jane', 'john', 'idle']:
+                user, = self.user.create([{
+                            'name': login.capitalize(),
+                            'login': login,
+                            'email': '%s@example.com' % login,
+                            }])
+                calendars += self.calendar.create([{
+                            'name': login,
+                            'owner': user.id,
+                            }])
+            self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Meeting',
+                        'dtstart': day.replace(hour=9 + i + j),
+                        'dtend': day.replace(hour=10 + i + j),
+                        } for i, calendar in enumerate(calendars[:-1])
+                    for j in range(i + 1)])
+            dtstart = day.replace(tzinfo=tzlocal)
+            dtend = dtstart + datetime.timedelta(days=1)
+
+            def periods(ical):
+                return [(f.fbtype_param, f.value)
+                    for f in ical.vfreebusy.contents.get('freebusy', [])]
+            calendar_ids = [c.id for c in calendars]
+            vfreebusies = self.calendar.freebusy_many(calendar_ids, dtstart,
+                dtend)
+            self.assertEqual(sorted(vfreebusies), sorted(calendar_ids))
+            for calendar_id in calendar_ids:
+                expected = self.calendar.freebusy(calendar_id, dtstart, dtend)
+                self.assertEqual(periods(vfreebusies[calendar_id]),
+                    periods(expected))
+                self.assertEqual(
+                    vfreebusies[calendar_id].vfreebusy.dtstart.value,
+                    expected.vfreebusy.dtstart.value)
+                self.assertEqual(
+                    vfreebusies[calendar_id].vfreebusy.dtend.value,
+                    expected.vfreebusy.dtend.value)
+            self.assertEqual([len(periods(vfreebusies[i]))
+                    for i in calendar_ids], [1, 2, 3, 0])
+
+            request = vobject.iCalendar()
+            request.add('method').value = 'REQUEST'
+            request.add('vfreebusy')
+            request.vfreebusy.add('dtstart').value = dtstart
+            request.vfreebusy.add('dtend').value = dtend
+            request.vfreebusy.add('dtstamp').value = dtstart
+            request.vfreebusy.add('uid').value = 'freebusy-many'
+            request.vfreebusy.add('organizer').value = \
+                'mailto:admin@example.com'
+            attendees = ['jane', 'unknown', 'admin', 'john', 'jane', 'idle']
+            for login in attendees:
+                request.vfreebusy.add('attendee').value = \
+                    'mailto:%s@example.com' % login
+            response = xml.dom.minidom.parseString(self.calendar.post(
+                    'Calendars/admin', request.serialize()))
+            responses = response.getElementsByTagName('C:response')
+            self.assertEqual(len(responses), len(attendees))
+            for login, response in zip(attendees, responses):
+                status, = response.getElementsByTagName('C:request-status')
+                data = response.getElementsByTagName('C:calendar-data')
+                if login == 'unknown':
+                    self.assertEqual(status.firstChild.data,
+                        '5.3;No scheduling support for user.')
+                    self.assertEqual(data, [])
+                    continue
+                self.assertEqual(status.firstChild.data, '2.0;Success')
+                vfreebusy = vobject.readOne(data[0].firstChild.data)
+                self.assertEqual(vfreebusy.vfreebusy.attendee.value,
+                    'mailto:%s@example.com' % login)
+                calendar, = [c for c in calendars if c.name == login]
+                expected = self.calendar.freebusy(calendar.id, dtstart,
+                    dtend)
+                self.assertEqual(periods(vfreebusy), periods(expected))
+
+    def test0100availability(self):
+        'Test the availability bitmaps'
+        Availability = POOL.get('calendar.calendar.availability')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendar = self.create_calendar()
+            self.calendar.update_availability([calendar])
+            self.assertEqual(Availability.search([]), [])
+
+            day = datetime.datetime.combine(
+                datetime.date.today() + datetime.timedelta(days=1),
+                datetime.time())
+            self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Weekly',
+                        'dtstart': day.replace(hour=9),
+                        'dtend': day.replace(hour=10),
+                        'rrules': [('create', [{
+                                        'freq': 'weekly',
+                                        'count': 3,
+                                        }])],
+                        }])
+            dates = [day.date() + datetime.timedelta(days=7 * i)
+                for i in range(3)]
+            self.assertEqual(sorted(a['date'] for a in Availability.read(
+                        [a.id for a in Availability.search([])],
+                        ['date'])), dates)
+
+            event, = self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Meeting',
+                        'dtstart': day.replace(hour=11, minute=10),
+                        'dtend': day.replace(hour=12),
+                        }])
+            self.assertEqual(len(Availability.search([])), 3)
+            self.assertTrue(self.calendar.is_available([calendar.id],
+                    day.replace(hour=11), day.replace(hour=11, minute=10)))
+            self.assertFalse(self.calendar.is_available([calendar.id],
+                    day.replace(hour=11), day.replace(hour=11, minute=20)))
+            self.assertFalse(self.calendar.is_available([calendar.id],
+                    day.replace(hour=11, minute=30), day.replace(hour=13)))
+
+            self.event.write([event], {
+                    'dtstart': day.replace(hour=14),
+                    'dtend': day.replace(hour=15),
+                    })
+            self.assertTrue(self.calendar.is_available([calendar.id],
+                    day.replace(hour=11), day.replace(hour=13)))
+            self.assertFalse(self.calendar.is_available([calendar.id],
+                    day.replace(hour=14, minute=50),
+                    day.replace(hour=16)))
+            self.event.delete([event])
+            self.assertTrue(self.calendar.is_available([calendar.id],
+                    day.replace(hour=14), day.replace(hour=16)))
+            self.assertEqual(len(Availability.search([])), 3)
+
+    def test0105availability_window(self):
+        'Test the window of the availability bitmaps'
+        Availability = POOL.get('calendar.calendar.availability')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendar = self.create_calendar()
+            today = datetime.date.today()
+            horizon = calendar.availability_until
+            day = datetime.datetime.combine(
+                today + datetime.timedelta(days=1), datetime.time(9))
+            event, = self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Weekly',
+                        'dtstart': day,
+                        'dtend': day.replace(hour=10),
+                        'rrules': [('create', [{
+                                        'freq': 'weekly',
+                                        }])],
+                        }])
+
+            def dates():
+                return sorted(a['date'] for a in Availability.read(
+                        [a.id for a in Availability.search([])], ['date']))
+            weekly = dates()
+            self.assertEqual(weekly[0], day.date())
+            self.assertTrue(weekly[-1] > horizon - datetime.timedelta(days=7))
+
+            # The bitmaps of the other days are kept
+            ids = set(a.id for a in Availability.search([]))
+            self.exdate.create([{
+                        'event': event.id,
+                        'datetime': day + datetime.timedelta(days=14),
+                        }])
+            self.assertEqual(len(ids - set(a.id
+                            for a in Availability.search([]))), 1)
+            self.assertEqual(dates(), weekly[:2] + weekly[3:])
+
+            # The cron moves the window up to the horizon
+            until = today + datetime.timedelta(days=20)
+            self.calendar.write([calendar], {'availability_until': until})
+            Availability.delete(Availability.search([
+                        ('date', '>', until),
+                        ]))
+            self.event.update_instance_window()
+            self.assertEqual(self.calendar.read([calendar.id],
+                    ['availability_until'])[0]['availability_until'],
+                horizon)
+            self.assertEqual(dates(), weekly[:2] + weekly[3:])
+
+            # The calendars without availability are built
+            self.calendar.write([calendar], {'availability_until': None})
+            Availability.delete(Availability.search([]))
+            self.event.update_instance_window()
+            self.assertEqual(dates(), weekly[:2] + weekly[3:])
+
+
+    def test0107free_slots(self):
+        'Test the search of free slots'
+        tzlocal = dateutil.tz.tzlocal()
+        hour = datetime.timedelta(hours=1)
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendar = self.create_calendar()
+            user, = self.user.create([{
+                        'name': 'Empty',
+                        'login': 'empty',
+                        'email': 'empty@example.com',
+                        }])
+            empty, = self.calendar.create([{
+                        'name': 'empty',
+                        'owner': user.id,
+                        }])
+            monday = datetime.datetime(2026, 10, 5)
+            tuesday = monday + datetime.timedelta(days=1)
+            self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': summary,
+                        'dtstart': dtstart,
+                        'dtend': dtend,
+                        } for summary, dtstart, dtend in [
+                        ('Breakfast', monday.replace(hour=7),
+                            monday.replace(hour=9)),
+                        ('Lunch', monday.replace(hour=12),
+                            monday.replace(hour=13)),
+                        ('Dinner', tuesday.replace(hour=17, minute=30),
+                            tuesday.replace(hour=19)),
+                        ]])
+            window_start = monday.replace(hour=8)
+            window_end = tuesday.replace(hour=18)
+
+            def starts(slots, duration):
+                for dtstart, dtend in slots:
+                    self.assertEqual(dtend - dtstart, duration)
+                return [s.astimezone(tzlocal).replace(tzinfo=None)
+                    for s, _ in slots]
+
+            slots = self.calendar.find_free_slots([empty.id], hour,
+                window_start, window_end, limit=3)
+            self.assertEqual(starts(slots, hour),
+                [monday.replace(hour=h) for h in (8, 9, 10)])
+
+            slots = self.calendar.find_free_slots([calendar.id, empty.id],
+                hour, window_start, window_end)
+            self.assertEqual(starts(slots, hour),
+                [monday.replace(hour=h) for h in (9, 10, 11, 13, 14, 15, 16,
+                        17, 18, 19)])
+
+            duration = datetime.timedelta(minutes=90)
+            slots = self.calendar.find_free_slots([calendar.id], duration,
+                window_start, window_end, limit=4)
+            self.assertEqual(starts(slots, duration), [
+                    monday.replace(hour=9), monday.replace(hour=10, minute=30),
+                    monday.replace(hour=13),
+                    monday.replace(hour=14, minute=30)])
+
+            slots = self.calendar.find_free_slots([calendar.id], hour,
+                window_start, window_end, working_hours=[
+                    (0, datetime.time(9), datetime.time(11, 30)),
+                    (1, datetime.time(14), datetime.time(18)),
+                    ])
+            self.assertEqual(starts(slots, hour),
+                [monday.replace(hour=9), monday.replace(hour=10),
+                    tuesday.replace(hour=14), tuesday.replace(hour=15),
+                    tuesday.replace(hour=16)])
+
+            slots = self.calendar.find_free_slots([calendar.id], hour,
+                window_start.replace(tzinfo=tzlocal),
+                monday.replace(hour=12, minute=30).replace(tzinfo=tzlocal))
+            self.assertEqual(starts(slots, hour),
+                [monday.replace(hour=h) for h in (9, 10, 11)])
+
+    @unittest.skipIf(calendar_.numpy is None, 'requires numpy')
+    def test0110numpy_recurrences(self):
+        'Test the numpy expansion against dateutil'
+        tzlocal = dateutil.tz.tzlocal()
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendar = self.create_calendar()
+            dtstart = datetime.datetime(2026, 1, 31, 9)
+            rules = [
+                {'freq': 'daily'},
+                {'freq': 'daily', 'interval': 3, 'count': 50},
+                {'freq': 'weekly', 'byday': 'MO,WE,FR'},
+                {'freq': 'weekly', 'interval': 2, 'byday': 'TU,SA',
+                    'wkst': 'su'},
+                {'freq': 'weekly', 'until': datetime.datetime(2026, 9, 1)},
+                {'freq': 'monthly', 'interval': 2},
+                ]
+            for rule in rules:
+                event, = self.event.create([{
+                            'calendar': calendar.id,
+                            'summary': 'Recurrent',
+                            'dtstart': dtstart.replace(day=15)
+                            if rule['freq'] == 'monthly' else dtstart,
+                            'rrules': [('create', [rule])],
+                            }])
+                self.exdate.create([{
+                            'event': event.id,
+                            'datetime': dtstart + datetime.timedelta(days=14),
+                            }])
+                self.assertTrue(calendar_._numpy_rrule(
+                        event.compile_rruleset()['rrules'][0]))
+                for start, end in [
+                        (None, datetime.datetime(2027, 1, 1)),
+                        (datetime.datetime(2026, 3, 10),
+                            datetime.datetime(2026, 7, 10)),
+                        ]:
+                    start = start and start.replace(tzinfo=tzlocal)
+                    end = end.replace(tzinfo=tzlocal)
+                    expected = event.get_rruleset(start).between(
+                        start or dtstart.replace(day=1, tzinfo=tzlocal), end,
+                        inc=True)
+                    self.assertEqual([r for r in event._iter_recurrences(
+                                start, end)
+                            if (start is None or r >= start) and r <= end],
+                        expected, rule)
+
+    def test0120entity_tag(self):
+        'Test the entity tags of calendars and events'
+        Collection = POOL.get('webdav.collection')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendar = self.create_calendar()
+            uri = 'Calendars/%s' % calendar.name
+            etag = Collection.get_etag(uri)
+            event, = self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Meeting',
+                        'dtstart': datetime.datetime(2026, 10, 5, 9),
+                        }])
+            self.assertNotEqual(Collection.get_etag(uri), etag)
+
+            etag = Collection.get_etag(uri)
+            event_uri = '%s/%s.ics' % (uri, event.uuid)
+            event_etag = Collection.get_etag(event_uri)
+            self.event.write([event], {'summary': 'Lunch'})
+            self.assertNotEqual(Collection.get_etag(event_uri), event_etag)
+            self.assertNotEqual(Collection.get_etag(uri), etag)
+
+    def test0130conditional_request(self):
+        'Test the conditional GET and PUT'
+        Collection = POOL.get('webdav.collection')
+
+        def request(method, path, headers, body=''):
+            response = self.dav_request(method, path, headers, body)
+            return response.split('\r\n')[0].split()[1]
+
+        def put(path, if_match, ics):
+            return request('PUT', path, 'If-Match: %s\r\n'
+                'Content-Length: %s\r\nContent-Type: text/calendar\r\n'
+                % (if_match, len(ics)), ics)
+
+        def summary(event_id):
+            return self.event.read([event_id], ['summary'])[0]['summary']
+
+        # A successful PUT commits
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            calendar = self.create_calendar()
+            event, = self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Meeting',
+                        'dtstart': datetime.datetime(2026, 10, 5, 9),
+                        }])
+            event_id = event.id
+            path = 'Calendars/%s/%s.ics' % (calendar.name, event.uuid)
+            ics = self.event.events2ics([event])[event.id]\
+                .replace('Meeting', 'Lunch')
+            transaction.cursor.commit()
+        try:
+            with Transaction().start(DB_NAME, USER, context=CONTEXT):
+                etag = Collection.get_etag(path)
+                self.assertEqual(request('GET', path,
+                        'If-None-Match: %s\r\n' % etag), '304')
+                self.assertEqual(request('GET', path,
+                        'If-None-Match: W/%s\r\n' % etag), '304')
+                self.assertEqual(request('GET', path,
+                        'If-None-Match: "0-0-0"\r\n'), '200')
+                self.assertEqual(request('GET', path,
+                        'If-Match: W/%s\r\n' % etag), '412')
+                self.assertEqual(request('GET', path,
+                        'If-Match: %s\r\n' % etag), '200')
+
+                self.assertEqual(put(path, 'W/%s' % etag, ics), '412')
+                self.assertEqual(put(path, '"0-0-0"', ics), '412')
+                self.assertEqual(summary(event_id), 'Meeting')
+                self.assertEqual(put(path, '"0-0-0", %s' % etag, ics),
+                    '201')
+                self.assertEqual(summary(event_id), 'Lunch')
+                self.assertEqual(put(path, etag, ics), '412')
+        finally:
+            with Transaction().start(DB_NAME, USER,
+                    context=CONTEXT) as transaction:
+                self.calendar.delete(self.calendar.search([]))
+                transaction.cursor.commit()
+
+    def test0135stream_calendar(self):
+        'Test the streamed GET of a calendar'
+        Collection = POOL.get('webdav.collection')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendar = self.create_calendar()
+            self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': u'R\xe9union %s' % i,
+                        'dtstart': datetime.datetime(2026, 10, 5, 9 + i),
+                        } for i in range(3)])
+            path = 'Calendars/%s.ics' % calendar.name
+            data = Collection.get_data(path)
+            self.assertIn('R\xc3\xa9union 2', data)
+
+            headers, body = self.dav_request('GET', path).split(
+                '\r\n\r\n', 1)
+            self.assertIn('Transfer-Encoding: chunked', headers)
+            chunks = []
+            while True:
+                size, body = body.split('\r\n', 1)
+                size = int(size, 16)
+                self.assertEqual(body[size:size + 2], '\r\n')
+                chunks.append(body[:size])
+                body = body[size + 2:]
+                if not size:
+                    break
+            self.assertEqual(body, '')
+            self.assertTrue(len(chunks) > 2)
+            self.assertEqual(''.join(chunks), data)
+
+            headers, body = self.dav_request('GET', path,
+                version='HTTP/1.0').split('\r\n\r\n', 1)
+            self.assertNotIn('Transfer-Encoding', headers)
+            self.assertIn('Connection: close', headers)
+            self.assertEqual(body, data)
+
+    def test0140sync_collection(self):
+        'Test the synchronization of a calendar'
+        from pywebdav.lib.errors import DAV_Forbidden
+        Collection = POOL.get('webdav.collection')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendar = self.create_calendar()
+            uri = 'Calendars/%s' % calendar.name
+            token = Collection.get_sync_token(uri)
+
+            first, second = self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': 'First',
+                        'dtstart': datetime.datetime(2026, 10, 5, 9),
+                        }, {
+                        'calendar': calendar.id,
+                        'summary': 'Second',
+                        'dtstart': datetime.datetime(2026, 10, 6, 9),
+                        }])
+            changed, removed, new_token = Collection.sync_collection(uri,
+                token)
+            self.assertEqual(changed,
+                sorted([first.uuid + '.ics', second.uuid + '.ics']))
+            self.assertEqual(removed, [])
+            self.assertNotEqual(new_token, token)
+            self.assertEqual(Collection.get_sync_token(uri), new_token)
+
+            token = new_token
+            first_uuid = first.uuid
+            self.event.write([second], {'summary': 'Lunch'})
+            self.event.delete([first])
+            changed, removed, new_token = Collection.sync_collection(uri,
+                token)
+            self.assertEqual(changed, [second.uuid + '.ics'])
+            self.assertEqual(removed, [first_uuid + '.ics'])
+            self.assertEqual(Collection.sync_collection(uri, new_token),
+                ([], [], new_token))
+
+            # The uuid created again is not removed
+            self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': 'First',
+                        'uuid': first_uuid,
+                        'dtstart': datetime.datetime(2026, 10, 5, 9),
+                        }])
+            self.assertEqual(Collection.sync_collection(uri, token)[:2],
+                (sorted([first_uuid + '.ics', second.uuid + '.ics']), []))
+
+            changed, removed, _ = Collection.sync_collection(uri, '')
+            self.assertEqual(changed,
+                sorted([first_uuid + '.ics', second.uuid + '.ics']))
+            self.assertEqual(removed, [])
+            for invalid in ['foo', 'data:,foo', 'data:,999']:
+                self.assertRaises(DAV_Forbidden, Collection.sync_collection,
+                    uri, invalid)
+
+    def test0150ctag(self):
+        'Test the change tag of a calendar'
+        Collection = POOL.get('webdav.collection')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendar = self.create_calendar()
+            uri = 'Calendars/%s' % calendar.name
+            self.assertEqual(Collection.get_ctag(uri), '0')
+            event, = self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Meeting',
+                        'dtstart': datetime.datetime(2026, 10, 5, 9),
+                        }])
+            ctag = Collection.get_ctag(uri)
+            self.assertNotEqual(ctag, '0')
+            self.event.write([event], {'summary': 'Lunch'})
+            self.assertNotEqual(Collection.get_ctag(uri), ctag)
+            ctag = Collection.get_ctag(uri)
+            self.event.delete([event])
+            self.assertNotEqual(Collection.get_ctag(uri), ctag)
+            self.assertEqual(Collection.get_ctag(uri),
+                Collection.get_sync_token(uri)[len('data:,'):])
+    def test0160calendar_multiget(self):
+        'Test the calendar-multiget of events'
+        Collection = POOL.get('webdav.collection')
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            calendar = self.create_calendar()
+            events = self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Event %s' % i,
+                        'dtstart': datetime.datetime(2026, 10, 5, 9 + i),
+                        } for i in range(3)])
+            uris = ['Calendars/admin/%s.ics' % e.uuid
+                for e in [events[2], events[0]]]
+            uris += [
+                'Calendars/admin/missing.ics',
+                'Calendars/unknown/%s.ics' % events[1].uuid,
+                'Calendars/admin',
+                uris[0],
+                ]
+            result = Collection.events(uris)
+            self.assertEqual(result, dict((uri, Collection.event(uri)
+                        if uri != 'Calendars/admin' else None)
+                    for uri in uris))
+            self.assertEqual([result[uri] for uri in uris],
+                [events[2].id, events[0].id, None, None, None, events[2].id])
+
+            doc = xml.dom.minidom.parseString(
+                '<C:calendar-multiget xmlns:D="DAV:" '
+                'xmlns:C="urn:ietf:params:xml:ns:caldav">'
+                + ''.join('<D:href>/%s/%s</D:href>' % (
+                        transaction.cursor.database_name, uri)
+                    for uri in uris)
+                + '<D:href/><D:href>/other/%s</D:href>' % uris[1]
+                + '</C:calendar-multiget>')
+            self.assertEqual(sorted(Collection.get_childs('Calendars/admin',
+                        filter=doc.documentElement)),
+                sorted(e.uuid + '.ics' for e in [events[2], events[0]]))
+    def test0170resolve(self):
+        'Test the resolution of the URIs'
+        Collection = POOL.get('webdav.collection')
+        with Transaction().start(DB_NAME, USER, context=CONTEXT):
+            calendar = self.create_calendar()
+            event, = self.event.create([{
+                        'calendar': calendar.id,
+                        'summary': 'Meeting',
+                        'dtstart': datetime.datetime(2026, 10, 5, 9),
+                        }])
+            for uri, expected in [
+                    ('Calendars', ('calendars', None, None)),
+                    ('Calendars/', ('calendars', None, None)),
+                    ('Calendars/admin', ('calendar', calendar.id, None)),
+                    ('Calendars/admin/', ('calendar', calendar.id, None)),
+                    ('Calendars/admin/%s.ics' % event.uuid,
+                        ('event', calendar.id, event.id)),
+                    ('Calendars/admin/missing.ics',
+                        ('event', calendar.id, None)),
+                    ('Calendars/admin.ics', ('ics', calendar.id, None)),
+                    ('Calendars/admin.vfb', ('vfb', calendar.id, None)),
+                    ('Calendars/unknown', (None, None, None)),
+                    ('Calendars/unknown.ics', (None, None, None)),
+                    ('Calendars/unknown.vfb', (None, None, None)),
+                    ('Calendars/unknown/%s.ics' % event.uuid,
+                        (None, None, None)),
+                    ('Other/admin', (None, None, None)),
+                    (None, (None, None, None)),
+                    ]:
+                self.assertEqual(Collection.resolve(uri), expected, uri)
+                cache = {}
+                self.assertEqual(Collection.resolve(uri, cache=cache),
+                    expected, uri)
+                self.assertEqual(cache['_calendar_uri'], {uri: expected})
+
+            # The resolution is memoized for the request
+            cache = {}
+            uri = 'Calendars/admin/%s.ics' % event.uuid
+            Collection.resolve(uri, cache=cache)
+            self.event.delete([event])
+            self.assertEqual(Collection.resolve(uri, cache=cache),
+                ('event', calendar.id, event.id))
+            self.assertEqual(Collection.resolve(uri, cache={}),
+                ('event', calendar.id, None))
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()
@@ -2,13 +2,18 @@
 # this repository contains the full copyright notices and license terms.
 import vobject
 import urllib
-from sql.functions import Extract
+import datetime
+import time
+import dateutil.tz
+from sql import Column
+from sql.functions import Extract, Lower, Position
 from sql.conditionals import Coalesce
-from sql.aggregate import Max
+from sql.aggregate import Max, Count, Sum
 
 from pywebdav.lib.errors import DAV_NotFound, DAV_Forbidden
 from trytond.tools import reduce_ids, grouped_slice
 from trytond.cache import Cache
+from trytond.config import config
 from trytond.transaction import Transaction
 from trytond.pool import Pool, PoolMeta
 
@@ -16,47 +21,143 @@ __all__ = ['Collection']
 __metaclass__ = PoolMeta
 
 CALDAV_NS = 'urn:ietf:params:xml:ns:caldav'
+# The fields of calendar.event for the properties of prop-filter
+PROP_FILTER_FIELDS = {
+    'SUMMARY': 'summary',
+    'CATEGORIES': 'categories.name',
+    'ATTENDEE': 'attendees.email',
+    'UID': 'uuid',
+    'STATUS': 'status',
+    }
 
 
-def _comp_filter_domain(dtstart, dtend):
+def _comp_filter_domain(dtstart, dtend, calendar_id=None):
+    pool = Pool()
+    Event = pool.get('calendar.event')
+    Instance = pool.get('calendar.event.instance')
+    instance = Instance.__table__()
+    # The dates are stored in local time
+    tzlocal = dateutil.tz.tzlocal()
+    if dtstart.tzinfo:
+        dtstart = dtstart.astimezone(tzlocal).replace(tzinfo=None)
+    if dtend.tzinfo:
+        dtend = dtend.astimezone(tzlocal).replace(tzinfo=None)
+    # Events which are not materialized over the period are expanded only if
+    # their recurrence may reach it
+    expanded = []
+    calendar_domain = []
+    if calendar_id:
+        calendar_domain = [('calendar', '=', calendar_id)]
+    for event in Event.search([
+                calendar_domain,
+                ('parent', '=', None),
+                ('dtstart', '<=', dtend),
+                ('is_recurrent', '=', True),
+                ['OR',
+                    [
+                        ('instances_from', '!=', None),
+                        ('instances_from', '>', dtstart),
+                        ],
+                    [
+                        ('instances_until', '!=', None),
+                        ('instances_until', '<', dtend),
+                        ['OR',
+                            ('recurrence_until', '=', None),
+                            ('recurrence_until', '>', dtstart),
+                            ],
+                        ],
+                    ],
+                ]):
+        for _ in event.iter_instances(dtstart.replace(tzinfo=tzlocal),
+                dtend.replace(tzinfo=tzlocal)):
+            expanded.append(event.id)
+            break
     return ['OR',
         [
-            ['OR',
-                [('dtstart', '<=', dtstart),
-                    ('dtend', '>=', dtstart)],
-                [('dtstart', '<=', dtend),
-                    ('dtend', '>=', dtend)],
-                [('dtstart', '>=', dtstart),
-                    ('dtend', '<=', dtend)],
-                [('dtstart', '>=', dtstart),
-                    ('dtstart', '<=', dtend),
-                    ('dtend', '=', None)]],
+            Event.overlap_domain(dtstart, dtend),
             ('parent', '=', None),
-            ('rdates', '=', None),
-            ('rrules', '=', None),
-            ('exdates', '=', None),
-            ('exrules', '=', None),
-            ('occurences', '=', None),
+            ('is_recurrent', '=', False),
             ],
-        [  # TODO manage better recurring event
+        [
             ('parent', '=', None),
             ('dtstart', '<=', dtend),
+            ('is_recurrent', '=', True),
             ['OR',
-                ('rdates', '!=', None),
-                ('rrules', '!=', None),
-                ('exdates', '!=', None),
-                ('exrules', '!=', None),
-                ('occurences', '!=', None),
-                ]
+                ('id', 'in', instance.select(instance.event,
+                        where=(instance.dtstart < dtend)
+                        & ((instance.dtend > dtstart)
+                            | (instance.dtstart >= dtstart)))),
+                ('id', 'in', expanded),
+                ],
             ]]
 
 
+def _prop_filter_domain(prop_filter):
+    '''
+    Return a domain for the caldav prop-filter on event or None if the
+    property is not supported
+    '''
+    Event = Pool().get('calendar.event')
+    name = prop_filter.getAttribute('name').upper()
+    if name not in PROP_FILTER_FIELDS:
+        return None
+    field = PROP_FILTER_FIELDS[name]
+    if '.' in field:
+        defined = [(field.split('.', 1)[0], '!=', None)]
+    else:
+        defined = [(field, 'not in', [None, ''])]
+    domain = list(defined)
+    for e in prop_filter.childNodes:
+        if e.nodeType != e.ELEMENT_NODE:
+            continue
+        if e.localName == 'is-not-defined':
+            return [('id', 'not in',
+                    Event.search(defined, order=[], query=True))]
+        elif e.localName == 'text-match':
+            value = ''.join(t.data for t in e.childNodes
+                if t.nodeType == t.TEXT_NODE).strip()
+            if name == 'ATTENDEE' and value.lower().startswith('mailto:'):
+                value = value[7:]
+            elif name == 'STATUS':
+                # The status is stored in lower case
+                value = value.lower()
+            domain.append(_text_match_domain(field, value,
+                    octet=(e.getAttribute('collation') == 'i;octet'
+                        and name != 'STATUS'),
+                    negate=e.getAttribute('negate-condition') == 'yes'))
+    return domain
+
+
+def _text_match_domain(field, value, octet=False, negate=False):
+    '''
+    Return a domain for the events with field containing value
+    The substring is searched with POSITION because the LIKE of the backends
+    do not escape the wildcards of the value the same way.
+    '''
+    Event = Pool().get('calendar.event')
+    if '.' in field:
+        field, name = field.split('.', 1)
+        Target = Event._fields[field].get_target()
+    else:
+        name, Target = field, Event
+        field = 'id'
+    table = Target.__table__()
+    column = Column(table, name)
+    if not octet:
+        column, value = Lower(column), value.lower()
+    where = Position(value, column) > 0
+    if negate:
+        where = ~where
+    return (field, 'in', table.select(table.id, where=where))
+
+
 class Collection:
     __name__ = "webdav.collection"
     _event_cache = Cache('webdav_collection.event')
+    _ics_cache = Cache('webdav_collection.ics', size_limit=32)
 
     @staticmethod
-    def calendar(uri, ics=False):
+    def calendar(uri, ics=False, vfb=False):
         '''
         Return the calendar id in the uri
         '''
@@ -69,6 +170,11 @@ class Collection:
                     calendar = calendar[:-4]
                 else:
                     return None
+            elif vfb:
+                if calendar.endswith('.vfb'):
+                    calendar = calendar[:-4]
+                else:
+                    return None
             return Calendar.get_name(calendar)
 
     @classmethod
@@ -100,6 +206,75 @@ class Collection:
         cls._event_cache.set(key, event_id)
         return event_id
 
+    @classmethod
+    def events(cls, uris):
+        '''
+        Return a dictionary of the event ids by uri
+        The uris are grouped by calendar to search their events at once
+        '''
+        Event = Pool().get('calendar.event')
+
+        result, uuids = {}, {}
+        for uri in uris:
+            event_id = cls._event_cache.get((uri, False), default=-1)
+            if event_id != -1:
+                result[uri] = event_id
+                continue
+            result[uri] = None
+            if uri and uri.startswith('Calendars/'):
+                calendar, event_uri = (uri[10:].split('/', 1) + [None])[0:2]
+                calendar_id = cls.calendar(uri)
+                if calendar_id and event_uri:
+                    uuids.setdefault(calendar_id, {}).setdefault(
+                        event_uri[:-4], []).append(uri)
+        for calendar_id, calendar_uuids in uuids.iteritems():
+            for sub_uuids in grouped_slice(calendar_uuids.keys()):
+                events = Event.search([
+                        ('calendar', '=', calendar_id),
+                        ('uuid', 'in', list(sub_uuids)),
+                        ('parent', '=', None),
+                        ])
+                for event in events:
+                    for uri in calendar_uuids[event.uuid]:
+                        if result[uri] is None:
+                            result[uri] = event.id
+            for calendar_uris in calendar_uuids.itervalues():
+                for uri in calendar_uris:
+                    cls._event_cache.set((uri, False), result[uri])
+        return result
+
+    @classmethod
+    def resolve(cls, uri, cache=None):
+        '''
+        Return the uri resolved as a tuple (type, calendar id, event id)
+        where type is 'calendars', 'calendar', 'event', 'ics', 'vfb' or None
+        The resolution is memoized in the cache of the request
+        '''
+        if cache is not None:
+            cache.setdefault('_calendar_uri', {})
+            if uri in cache['_calendar_uri']:
+                return cache['_calendar_uri'][uri]
+        res = (None, None, None)
+        if uri in ('Calendars', 'Calendars/'):
+            res = ('calendars', None, None)
+        elif uri and uri.startswith('Calendars/'):
+            calendar_id = cls.calendar(uri)
+            if calendar_id:
+                if not (uri[10:].split('/', 1) + [None])[1]:
+                    res = ('calendar', calendar_id, None)
+                else:
+                    res = ('event', calendar_id,
+                        cls.event(uri, calendar_id=calendar_id))
+            else:
+                for type_ in ('ics', 'vfb'):
+                    calendar_id = cls.calendar(uri, **{type_: True})
+                    if calendar_id:
+                        res = (type_, calendar_id, None)
+                        break
+        if cache is not None:
+            cache['_calendar_uri'][uri] = res
+        return res
+
     @staticmethod
     def _caldav_filter_domain_calendar(filter):
         '''
@@ -112,9 +287,9 @@ class Collection:
         return [('id', '=', 0)]
 
     @classmethod
-    def _caldav_filter_domain_event(cls, filter):
+    def _caldav_filter_domain_event(cls, filter, calendar_id=None):
         '''
-        Return a domain for caldav filter on event
+        Return a domain for caldav filter on event of the calendar
         '''
         res = []
         if not filter:
@@ -147,20 +322,26 @@ class Collection:
                             vevent_filter = None
                             continue
                         for comp_filter in vevent_filter.childNodes:
+                            if comp_filter.localName == 'prop-filter':
+                                domain = _prop_filter_domain(comp_filter)
+                                if domain is not None:
+                                    result.append(domain)
+                                continue
                             if comp_filter.localName != 'time-range':
                                 continue
                             start = comp_filter.getAttribute('start')
                             start = vobject.icalendar.stringToDateTime(start)
                             end = comp_filter.getAttribute('end')
                             end = vobject.icalendar.stringToDateTime(end)
-                            result.append(_comp_filter_domain(start, end))
+                            result.append(_comp_filter_domain(start, end,
+                                    calendar_id=calendar_id))
                         break
                 if vevent_filter is None:
                     return [('id', '=', 0)]
                 break
             return result
         elif filter.localName == 'calendar-multiget':
-            ids = []
+            uris = []
             for e in filter.childNodes:
                 if e.nodeType == e.TEXT_NODE:
                     continue
@@ -176,9 +357,8 @@ class Collection:
                         continue
                     if uri:
                         uri = urllib.unquote_plus(uri)
-                    event_id = cls.event(uri)
-                    if event_id:
-                        ids.append(event_id)
+                    uris.append(uri)
+            ids = [i for i in cls.events(uris).itervalues() if i]
             return [('id', 'in', ids)]
         return res
 
@@ -202,11 +382,13 @@ class Collection:
                 for calendar in calendars:
                     cache['_calendar'][Calendar.__name__][calendar.id] = {}
             return ([x.name for x in calendars]
-                + [x.name + '.ics' for x in calendars])
+                + [x.name + '.ics' for x in calendars]
+                + [x.name + '.vfb' for x in calendars])
         if uri and uri.startswith('Calendars/'):
-            calendar_id = cls.calendar(uri)
-            if calendar_id and not (uri[10:].split('/', 1) + [None])[1]:
-                domain = cls._caldav_filter_domain_event(filter)
+            type_, calendar_id, _ = cls.resolve(uri, cache=cache)
+            if type_ == 'calendar':
+                domain = cls._caldav_filter_domain_event(filter,
+                    calendar_id=calendar_id)
                 events = Event.search([
                         ('calendar', '=', calendar_id),
                         domain,
@@ -230,35 +412,29 @@ class Collection:
     @classmethod
     def get_resourcetype(cls, uri, cache=None):
         from pywebdav.lib.constants import COLLECTION, OBJECT
-        if uri in ('Calendars', 'Calendars/'):
+        type_, _, _ = cls.resolve(uri, cache=cache)
+        if type_ in ('calendars', 'calendar'):
             return COLLECTION
-        calendar_id = cls.calendar(uri)
-        if calendar_id:
-            if not (uri[10:].split('/', 1) + [None])[1]:
-                return COLLECTION
-            return OBJECT
-        elif cls.calendar(uri, ics=True):
+        elif type_ in ('event', 'ics', 'vfb'):
             return OBJECT
         return super(Collection, cls).get_resourcetype(uri, cache=cache)
 
     @classmethod
     def get_displayname(cls, uri, cache=None):
         Calendar = Pool().get('calendar.calendar')
-        if uri in ('Calendars', 'Calendars/'):
+        type_, calendar_id, _ = cls.resolve(uri, cache=cache)
+        if type_ == 'calendars':
             return 'Calendars'
-        calendar_id = cls.calendar(uri)
-        if calendar_id:
-            if not (uri[10:].split('/', 1) + [None])[1]:
-                return Calendar(calendar_id).rec_name
-            return uri.split('/')[-1]
-        elif cls.calendar(uri, ics=True):
+        elif type_ == 'calendar':
+            return Calendar(calendar_id).rec_name
+        elif type_ in ('event', 'ics', 'vfb'):
             return uri.split('/')[-1]
         return super(Collection, cls).get_displayname(uri, cache=cache)
 
     @classmethod
     def get_contenttype(cls, uri, cache=None):
-        if cls.event(uri) \
-                or cls.calendar(uri, ics=True):
+        type_, _, event_id = cls.resolve(uri, cache=cache)
+        if (type_ == 'event' and event_id) or type_ in ('ics', 'vfb'):
             return 'text/calendar'
         return super(Collection, cls).get_contenttype(uri, cache=cache)
 
@@ -269,11 +445,9 @@ class Collection:
         calendar = Calendar.__table__()
         event = Event.__table__()
 
-        calendar_id = cls.calendar(uri)
-        if not calendar_id:
-            calendar_id = cls.calendar(uri, ics=True)
-        if calendar_id:
-            if not (uri[10:].split('/', 1) + [None])[1]:
+        type_, calendar_id, event_id = cls.resolve(uri, cache=cache)
+        if type_ in ('calendar', 'event', 'ics', 'vfb'):
+            if type_ != 'event':
                 if cache is not None:
                     cache.setdefault('_calendar', {})
                     cache['_calendar'].setdefault(Calendar.__name__, {})
@@ -304,7 +478,6 @@ class Collection:
                 if res is not None:
                     return res
             else:
-                event_id = cls.event(uri, calendar_id=calendar_id)
                 if event_id:
                     if cache is not None:
                         cache.setdefault('_calendar', {})
@@ -342,13 +515,15 @@ class Collection:
         pool = Pool()
         Calendar = pool.get('calendar.calendar')
         Event = pool.get('calendar.event')
+        Tombstone = pool.get('calendar.event.tombstone')
         calendar = Calendar.__table__()
         event = Event.__table__()
+        tombstone = Tombstone.__table__()
 
         cursor = Transaction().cursor
-        calendar_id = cls.calendar(uri)
-        if calendar_id:
-            if not (uri[10:].split('/', 1) + [None])[1]:
+        type_, calendar_id, event_id = cls.resolve(uri, cache=cache)
+        if type_ in ('calendar', 'event'):
+            if type_ == 'calendar':
                 if cache is not None:
                     cache.setdefault('_calendar', {})
                     cache['_calendar'].setdefault(Calendar.__name__, {})
@@ -379,7 +554,6 @@ class Collection:
                 if res is not None:
                     return res
             else:
-                event_id = cls.event(uri, calendar_id=calendar_id)
                 if event_id:
                     if cache is not None:
                         cache.setdefault('_calendar', {})
@@ -413,8 +587,8 @@ class Collection:
                                     event_id2]['lastmodified'] = date
                     if res is not None:
                         return res
-        calendar_ics_id = cls.calendar(uri, ics=True)
-        if calendar_ics_id:
+        if type_ == 'ics':
+            calendar_ics_id = calendar_id
             if cache is not None:
                 cache.setdefault('_calendar', {})
                 cache['_calendar'].setdefault(Calendar.__name__, {})
@@ -445,62 +619,369 @@ class Collection:
                             calendar_id2]['lastmodified ics'] = date
             if res is not None:
                 return res
+        if type_ == 'vfb':
+            calendar_vfb_id = calendar_id
+            if cache is not None:
+                cache.setdefault('_calendar', {})
+                cache['_calendar'].setdefault(Calendar.__name__, {})
+                ids = cache['_calendar'][Calendar.__name__].keys()
+                if calendar_vfb_id not in ids:
+                    ids.append(calendar_vfb_id)
+                elif 'lastmodified vfb' in cache['_calendar'][
+                        Calendar.__name__][calendar_vfb_id]:
+                    return cache['_calendar'][Calendar.__name__][
+                        calendar_vfb_id]['lastmodified vfb']
+            else:
+                ids = [calendar_vfb_id]
+            # The published window moves at midnight
+            today = time.mktime(datetime.date.today().timetuple())
+            res = today
+            for sub_ids in grouped_slice(ids):
+                dates = {}
+                for table in (event, tombstone):
+                    cursor.execute(*table.select(table.calendar,
+                            Max(Extract('EPOCH', Coalesce(table.write_date,
+                                        table.create_date))),
+                            where=reduce_ids(table.calendar, sub_ids),
+                            group_by=table.calendar))
+                    for calendar_id2, date in cursor.fetchall():
+                        dates[calendar_id2] = max(date,
+                            dates.get(calendar_id2))
+                for calendar_id2 in sub_ids:
+                    date = max(dates.get(calendar_id2), today)
+                    if calendar_id2 == calendar_vfb_id:
+                        res = date
+                    if cache is not None:
+                        cache['_calendar'][Calendar.__name__]\
+                            .setdefault(calendar_id2, {})
+                        cache['_calendar'][Calendar.__name__][
+                            calendar_id2]['lastmodified vfb'] = date
+            return res
         return super(Collection, cls).get_lastmodified(uri, cache=cache)
 
+    @staticmethod
+    def _etag(count, sequence, date):
+        '''
+        Return the entity tag for the number of events, the sum of their
+        sequence and their last modification
+        '''
+        return '"%s-%s-%s"' % (count, sequence,
+            ''.join(c for c in str(date) if c.isdigit()))
+
+    @classmethod
+    def get_etag(cls, uri, cache=None):
+        '''
+        Return the entity tag of the calendar or event in the uri
+        It changes on any modification, creation or deletion of the events
+        '''
+        pool = Pool()
+        Calendar = pool.get('calendar.calendar')
+        Event = pool.get('calendar.event')
+        event = Event.__table__()
+
+        cursor = Transaction().cursor
+        type_, calendar_id, event_id = cls.resolve(uri, cache=cache)
+        if type_ not in ('calendar', 'event', 'ics'):
+            return None
+        last_modified = Max(Coalesce(event.write_date, event.create_date))
+        if type_ != 'event':
+            if cache is not None:
+                cache.setdefault('_calendar', {})
+                cache['_calendar'].setdefault(Calendar.__name__, {})
+                ids = cache['_calendar'][Calendar.__name__].keys()
+                if calendar_id not in ids:
+                    ids.append(calendar_id)
+                elif 'etag' in cache['_calendar'][
+                        Calendar.__name__][calendar_id]:
+                    return cache['_calendar'][Calendar.__name__][
+                        calendar_id]['etag']
+            else:
+                ids = [calendar_id]
+            res = cls._etag(0, 0, None)
+            for sub_ids in grouped_slice(ids):
+                red_sql = reduce_ids(event.calendar, sub_ids)
+                cursor.execute(*event.select(event.calendar,
+                        Count(event.id), Sum(Coalesce(event.sequence, 0)),
+                        last_modified,
+                        where=red_sql,
+                        group_by=event.calendar))
+                for calendar_id2, count, sequence, date in cursor.fetchall():
+                    etag = cls._etag(count, sequence, date)
+                    if calendar_id2 == calendar_id:
+                        res = etag
+                    if cache is not None:
+                        cache['_calendar'][Calendar.__name__]\
+                            .setdefault(calendar_id2, {})
+                        cache['_calendar'][Calendar.__name__][
+                            calendar_id2]['etag'] = etag
+            return res
+        if not event_id:
+            return None
+        if cache is not None:
+            cache.setdefault('_calendar', {})
+            cache['_calendar'].setdefault(Event.__name__, {})
+            ids = cache['_calendar'][Event.__name__].keys()
+            if event_id not in ids:
+                ids.append(event_id)
+            elif 'etag' in cache['_calendar'][Event.__name__][event_id]:
+                return cache['_calendar'][Event.__name__][event_id]['etag']
+        else:
+            ids = [event_id]
+        res = None
+        for sub_ids in grouped_slice(ids, cursor.IN_MAX / 2):
+            red_id_sql = reduce_ids(event.id, sub_ids)
+            red_parent_sql = reduce_ids(event.parent, sub_ids)
+            parent = Coalesce(event.parent, event.id)
+            cursor.execute(*event.select(parent,
+                    Count(event.id), Sum(Coalesce(event.sequence, 0)),
+                    last_modified,
+                    where=red_id_sql | red_parent_sql,
+                    group_by=parent))
+            for event_id2, count, sequence, date in cursor.fetchall():
+                etag = cls._etag(count, sequence, date)
+                if event_id2 == event_id:
+                    res = etag
+                if cache is not None:
+                    cache['_calendar'][Event.__name__]\
+                        .setdefault(event_id2, {})
+                    cache['_calendar'][Event.__name__][
+                        event_id2]['etag'] = etag
+        return res
+
     @classmethod
     def get_data(cls, uri, cache=None):
         pool = Pool()
         Event = pool.get('calendar.event')
         Calendar = pool.get('calendar.calendar')
 
-        calendar_id = cls.calendar(uri)
-        if calendar_id:
-            if not (uri[10:].split('/', 1) + [None])[1]:
-                raise DAV_NotFound
-            event_id = cls.event(uri, calendar_id=calendar_id)
+        type_, calendar_id, event_id = cls.resolve(uri, cache=cache)
+        if type_ == 'calendar':
+            raise DAV_NotFound
+        elif type_ == 'event':
             if not event_id:
                 raise DAV_NotFound
-            ical = Event(event_id).event2ical()
-            return ical.serialize()
-        calendar_ics_id = cls.calendar(uri, ics=True)
-        if calendar_ics_id:
-            ical = Calendar(calendar_ics_id).calendar2ical()
-            return ical.serialize()
+            if cache is not None:
+                cache.setdefault('_calendar', {})
+                cache['_calendar'].setdefault(Event.__name__, {})
+                ids = cache['_calendar'][Event.__name__].keys()
+                if event_id not in ids:
+                    ids.append(event_id)
+                elif 'data' in cache['_calendar'][Event.__name__][event_id]:
+                    return cache['_calendar'][Event.__name__][event_id][
+                        'data']
+            else:
+                ids = [event_id]
+            res = None
+            for sub_ids in grouped_slice(ids):
+                icss = Event.events2ics(Event.browse(list(sub_ids)))
+                for event_id2, data in icss.iteritems():
+                    if event_id2 == event_id:
+                        res = data
+                    if cache is not None:
+                        cache['_calendar'][Event.__name__]\
+                            .setdefault(event_id2, {})
+                        cache['_calendar'][Event.__name__][
+                            event_id2]['data'] = data
+            return res
+        elif type_ == 'ics':
+            return ''.join(cls.get_data_stream(uri, cache=cache))
+        elif type_ == 'vfb':
+            return Calendar.published_freebusy([calendar_id])[calendar_id]
         return super(Collection, cls).get_data(uri, cache=cache)
 
+    @classmethod
+    def get_data_stream(cls, uri, cache=None):
+        '''
+        Return an iterator over the data of the calendar .ics by chunks
+        The data is cached by the sync token of the calendar if it is not
+        bigger than the ics_cache_size of the configuration and if the
+        calendar is not changed by the transaction
+        '''
+        Calendar = Pool().get('calendar.calendar')
+
+        type_, calendar_ics_id, _ = cls.resolve(uri, cache=cache)
+        if type_ == 'ics':
+            key = None
+            if not Calendar._sync_token_changed(calendar_ics_id):
+                key = (calendar_ics_id,
+                    Calendar._sync_tokens([calendar_ics_id])[calendar_ics_id])
+                data = cls._ics_cache.get(key)
+                if data is not None:
+                    return iter([data])
+            size_limit = config.getint('calendar', 'ics_cache_size',
+                default=1024 * 1024)
+
+            def stream():
+                chunks, size = [], 0
+                for chunk in Calendar(calendar_ics_id).calendar2ical_stream():
+                    if chunks is not None:
+                        chunks.append(chunk)
+                        size += len(chunk)
+                        if size > size_limit:
+                            chunks = None
+                    yield chunk
+                if key is not None and chunks is not None:
+                    cls._ics_cache.set(key, ''.join(chunks))
+            return stream()
+        raise DAV_NotFound
+
+    @staticmethod
+    def _sync_token(sync_token):
+        '''
+        Return the sync token URI for the sync token of a calendar
+        '''
+        return 'data:,%s' % sync_token
+
+    @staticmethod
+    def _calendar_sync_token(calendar_id):
+        '''
+        Return the current sync token of the calendar
+        It is read from the table as it is updated by SQL
+        '''
+        Calendar = Pool().get('calendar.calendar')
+        cursor = Transaction().cursor
+        calendar = Calendar.__table__()
+
+        cursor.execute(*calendar.select(calendar.sync_token,
+                where=calendar.id == calendar_id))
+        sync_token, = cursor.fetchone()
+        return sync_token or 0
+
+    @classmethod
+    def get_sync_token(cls, uri, cache=None):
+        '''
+        Return the sync token of the calendar in the uri
+        '''
+        type_, calendar_id, _ = cls.resolve(uri, cache=cache)
+        if type_ == 'calendar':
+            return cls._sync_token(cls._calendar_sync_token(calendar_id))
+        raise DAV_NotFound
+
+    @classmethod
+    def get_ctag(cls, uri, cache=None):
+        '''
+        Return the change tag of the calendar in the uri
+        It is the sync token which is incremented on any change of the events
+        '''
+        Calendar = Pool().get('calendar.calendar')
+        calendar = Calendar.__table__()
+        cursor = Transaction().cursor
+
+        type_, calendar_id, _ = cls.resolve(uri, cache=cache)
+        if type_ != 'calendar':
+            raise DAV_NotFound
+        if cache is not None:
+            cache.setdefault('_calendar', {})
+            cache['_calendar'].setdefault(Calendar.__name__, {})
+            ids = cache['_calendar'][Calendar.__name__].keys()
+            if calendar_id not in ids:
+                ids.append(calendar_id)
+            elif 'ctag' in cache['_calendar'][Calendar.__name__][calendar_id]:
+                return cache['_calendar'][Calendar.__name__][calendar_id][
+                    'ctag']
+        else:
+            ids = [calendar_id]
+        res = None
+        for sub_ids in grouped_slice(ids):
+            cursor.execute(*calendar.select(calendar.id, calendar.sync_token,
+                    where=reduce_ids(calendar.id, sub_ids)))
+            for calendar_id2, sync_token in cursor.fetchall():
+                ctag = str(sync_token or 0)
+                if calendar_id2 == calendar_id:
+                    res = ctag
+                if cache is not None:
+                    cache['_calendar'][Calendar.__name__]\
+                        .setdefault(calendar_id2, {})
+                    cache['_calendar'][Calendar.__name__][
+                        calendar_id2]['ctag'] = ctag
+        return res
+
+    @classmethod
+    def sync_collection(cls, uri, sync_token, cache=None):
+        '''
+        Return the childs of the calendar in the uri changed and removed
+        since the sync token and the current sync token of the calendar
+        An empty sync token returns all the childs
+        '''
+        pool = Pool()
+        Event = pool.get('calendar.event')
+        Tombstone = pool.get('calendar.event.tombstone')
+
+        type_, calendar_id, _ = cls.resolve(uri, cache=cache)
+        if type_ != 'calendar':
+            raise DAV_NotFound
+        # Read the current token first to not miss later changes
+        current = cls._calendar_sync_token(calendar_id)
+        domain = [('calendar', '=', calendar_id)]
+        if sync_token:
+            prefix = cls._sync_token('')
+            if not sync_token.startswith(prefix):
+                raise DAV_Forbidden
+            try:
+                sync_token = int(sync_token[len(prefix):])
+            except ValueError:
+                raise DAV_Forbidden
+            if not 0 <= sync_token <= current:
+                raise DAV_Forbidden
+            domain.append(('sync_token', '>', sync_token))
+        else:
+            sync_token = None
+        events = Event.search(domain)
+        if cache is not None:
+            cache.setdefault('_calendar', {})
+            cache['_calendar'].setdefault(Event.__name__, {})
+            for event in events:
+                cache['_calendar'][Event.__name__][event.id] = {}
+        changed = set(e.uuid for e in events)
+        removed = set()
+        if sync_token is not None:
+            tombstones = Tombstone.search([
+                    ('calendar', '=', calendar_id),
+                    ('sync_token', '>', sync_token),
+                    ])
+            removed = set(t.uuid for t in tombstones) - changed
+        if removed:
+            # The uuid may have been created again
+            removed -= set(e.uuid for e in Event.search([
+                        ('calendar', '=', calendar_id),
+                        ('uuid', 'in', list(removed)),
+                        ]))
+        return ([x + '.ics' for x in sorted(changed)],
+            [x + '.ics' for x in sorted(removed)],
+            cls._sync_token(current))
+
     @classmethod
     def get_calendar_description(cls, uri, cache=None):
         Calendar = Pool().get('calendar.calendar')
 
-        calendar_id = cls.calendar(uri)
-        if calendar_id:
-            if not (uri[10:].split('/', 1) + [None])[1]:
+        type_, calendar_id, _ = cls.resolve(uri, cache=cache)
+        if type_ == 'calendar':
+            if cache is not None:
+                cache.setdefault('_calendar', {})
+                cache['_calendar'].setdefault(Calendar.__name__, {})
+                ids = cache['_calendar'][Calendar.__name__].keys()
+                if calendar_id not in ids:
+                    ids.append(calendar_id)
+                elif 'calendar_description' in cache['_calendar'][
+                        Calendar.__name__][calendar_id]:
+                    res = cache['_calendar'][Calendar.__name__][
+                        calendar_id]['calendar_description']
+                    if res is not None:
+                        return res
+            else:
+                ids = [calendar_id]
+            res = None
+            for calendar in Calendar.browse(ids):
+                if calendar.id == calendar_id:
+                    res = calendar.description
                 if cache is not None:
-                    cache.setdefault('_calendar', {})
-                    cache['_calendar'].setdefault(Calendar.__name__, {})
-                    ids = cache['_calendar'][Calendar.__name__].keys()
-                    if calendar_id not in ids:
-                        ids.append(calendar_id)
-                    elif 'calendar_description' in cache['_calendar'][
-                            Calendar.__name__][calendar_id]:
-                        res = cache['_calendar'][Calendar.__name__][
-                            calendar_id]['calendar_description']
-                        if res is not None:
-                            return res
-                else:
-                    ids = [calendar_id]
-                res = None
-                for calendar in Calendar.browse(ids):
-                    if calendar.id == calendar_id:
-                        res = calendar.description
-                    if cache is not None:
-                        cache['_calendar'][Calendar.__name__]\
-                            .setdefault(calendar.id, {})
-                        cache['_calendar'][Calendar.__name__][
-                            calendar.id]['calendar_description'] = \
-                                calendar.description
-                if res is not None:
-                    return res
+                    cache['_calendar'][Calendar.__name__]\
+                        .setdefault(calendar.id, {})
+                    cache['_calendar'][Calendar.__name__][
+                        calendar.id]['calendar_description'] = \
+                            calendar.description
+            if res is not None:
+                return res
         raise DAV_NotFound
 
     @classmethod
@@ -543,11 +1024,13 @@ class Collection:
         Event = pool.get('calendar.event')
         Calendar = pool.get('calendar.calendar')
 
-        calendar_id = cls.calendar(uri)
-        if calendar_id:
-            if not (uri[10:].split('/', 1) + [None])[1]:
-                raise DAV_Forbidden
-            event_id = cls.event(uri, calendar_id=calendar_id)
+        type_, calendar_id, event_id = cls.resolve(uri)
+        if cache is not None:
+            # The uri is changed
+            cache.get('_calendar_uri', {}).pop(uri, None)
+        if type_ == 'calendar':
+            raise DAV_Forbidden
+        elif type_ == 'event':
             if not event_id:
                 ical = vobject.readOne(data)
                 values = Event.ical2values(None, ical, calendar_id)
@@ -560,8 +1043,7 @@ class Collection:
                 values = Event.ical2values(event_id, ical, calendar_id)
                 Event.write([Event(event_id)], values)
                 return
-        calendar_ics_id = cls.calendar(uri, ics=True)
-        if calendar_ics_id:
+        elif type_ in ('ics', 'vfb'):
             raise DAV_Forbidden
         return super(Collection, cls).put(uri, data, content_type)
 
@@ -575,14 +1057,17 @@ class Collection:
     def rmcol(cls, uri, cache=None):
         Calendar = Pool().get('calendar.calendar')
 
-        calendar_id = cls.calendar(uri)
-        if calendar_id:
-            if not (uri[10:].split('/', 1) + [None])[1]:
-                try:
-                    Calendar.delete([Calendar(calendar_id)])
-                except Exception:
-                    raise DAV_Forbidden
-                return 200
+        type_, calendar_id, _ = cls.resolve(uri)
+        if cache is not None:
+            # The uri is removed
+            cache.get('_calendar_uri', {}).pop(uri, None)
+        if type_ == 'calendar':
+            try:
+                Calendar.delete([Calendar(calendar_id)])
+            except Exception:
+                raise DAV_Forbidden
+            return 200
+        elif type_ == 'event':
             raise DAV_Forbidden
         return super(Collection, cls).rmcol(uri, cache=cache)
 
@@ -590,11 +1075,13 @@ class Collection:
     def rm(cls, uri, cache=None):
         Event = Pool().get('calendar.event')
 
-        calendar_id = cls.calendar(uri)
-        if calendar_id:
-            if not (uri[10:].split('/', 1) + [None])[1]:
-                return 403
-            event_id = cls.event(uri, calendar_id=calendar_id)
+        type_, _, event_id = cls.resolve(uri)
+        if cache is not None:
+            # The uri is removed
+            cache.get('_calendar_uri', {}).pop(uri, None)
+        if type_ in ('calendar', 'ics', 'vfb'):
+            return 403
+        elif type_ == 'event':
             if event_id:
                 try:
                     Event.delete([Event(event_id)])
@@ -602,23 +1089,14 @@ class Collection:
                     return 403
                 return 200
             return 404
-        calendar_ics_id = cls.calendar(uri, ics=True)
-        if calendar_ics_id:
-            return 403
         return super(Collection, cls).rm(uri, cache=cache)
 
     @classmethod
     def exists(cls, uri, cache=None):
-        if uri in ('Calendars', 'Calendars/'):
+        type_, _, event_id = cls.resolve(uri, cache=cache)
+        if type_ in ('calendars', 'calendar', 'ics', 'vfb'):
             return 1
-        calendar_id = cls.calendar(uri)
-        if calendar_id:
-            if not (uri[10:].split('/', 1) + [None])[1]:
-                return 1
-            if cls.event(uri, calendar_id=calendar_id):
-                return 1
-        calendar_ics_id = cls.calendar(uri, ics=True)
-        if calendar_ics_id:
+        elif type_ == 'event' and event_id:
             return 1
         return super(Collection, cls).exists(uri, cache=cache)
 
@@ -633,8 +1111,8 @@ class Collection:
         if uri in ('Calendars', 'Calendars/'):
             return ['create', 'read', 'write', 'delete']
         if uri and uri.startswith('Calendars/'):
-            calendar_id = cls.calendar(uri)
-            if calendar_id:
+            type_, calendar_id, _ = cls.resolve(uri, cache=cache)
+            if type_ in ('calendar', 'event'):
                 calendar = Calendar(calendar_id)
                 user = Transaction().user
                 if user == calendar.owner.id: